@@ -2,25 +2,1184 @@ import math
 import sys
 import shutil
 import os
-import numpy as np
 import abc
+import argparse
+import atexit
+import importlib.util
+import re
+import select
+import signal
+import threading
+import time
+import collections
+import mmap
+import struct
 
-SCREEN_WIDTH = shutil.get_terminal_size().columns
-SCREEN_HEIGHT = shutil.get_terminal_size().lines
+
+def lazy_import(name):
+    """ 最初に属性を参照したときに読み込まれるモジュールを返す """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named {!r}".format(name), name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# NumPy takes longer to import than everything else together, so it is
+# only loaded when first used (or by preload_numpy() in the background)
+np = lazy_import("numpy")
+
+SCREEN_WIDTH, SCREEN_HEIGHT = shutil.get_terminal_size()
 
 MAX_RAD = 2 * math.pi
 
 K1 = 30
 
+# Share of the screen the object may fill when the projection is fitted
+SCREEN_FILL = 0.75
+
+# Direction of the light. Its length is normalized to sqrt(2), the length
+# of the original (0, 1, -1), so the full palette stays in use.
+LIGHT = (0, 1, -1)
+
+# Index 0 is an empty cell, 1..12 are the luminance characters
+PALETTE = b" .,-~:;=!*#$@"
+
+# bytes.translate() table from luminance index to character
+PALETTE_TABLE = PALETTE + bytes(range(len(PALETTE), 256))
+
+LINE_END = os.linesep.encode()
+
+# Object types and ways of clearing the screen accepted on the command line
+OBJECT_TYPES = ("donut", "cube")
+CLEAR_TYPES = ("escape", "delta", "win", "linux")
+
+# Default target frame rate (0 = as fast as possible)
+DEFAULT_FPS = 30
+
+# Default memory budget of the frame cache
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Default size limit of the on-disk frame cache
+DEFAULT_DISK_CACHE_BYTES = 256 * 1024 * 1024
+
+# Default memory budget of the geometry cache (about 1 MB per A at 80x24)
+DEFAULT_GEOMETRY_BYTES = 128 * 1024 * 1024
+
+# Most recent stage timings kept for --trace
+TRACE_EVENTS = 100000
+
+# Frames each backend draws when --backend auto times them
+CALIBRATION_FRAMES = 5
+
+# Largest --lod, and the most surface samples one object may have whatever
+# the screen size and --lod (about 1000x300 at --lod 1)
+MAX_LOD = 16
+MAX_SAMPLES = 4000000
+
+
+def default_cache_dir():
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ascii-animation")
+
+
+class FrameCache:
+    """ 使用メモリ量に上限のある LRU フレームキャッシュ (フレームはエンコード済みの bytes) """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._frames = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        # Membership test without touching the LRU order or the counters
+        return key in self._frames
+
+    def get(self, key):
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self._frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def sizeof(self, frame):
+        return len(frame)
+
+    def put(self, key, frame):
+        size = self.sizeof(frame)
+        if size > self.max_bytes:
+            return
+
+        old = self._frames.pop(key, None)
+        if old is not None:
+            self.nbytes -= self.sizeof(old)
+        self._frames[key] = frame
+        self.nbytes += size
+
+        # Evict the least recently used frames until we fit the budget again
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._frames.popitem(last=False)
+            self.nbytes -= self.sizeof(evicted)
+            self.evictions += 1
+
+    def summary(self):
+        return "cache: {} frames, {} bytes, {} hits, {} misses, {} evictions".format(
+            len(self), self.nbytes, self.hits, self.misses, self.evictions)
+
+
+class GeometryCache(FrameCache):
+    """ A と C で回転させた点群 (ndarray のタプル) を保持する LRU キャッシュ """
+
+    def __init__(self, max_bytes=DEFAULT_GEOMETRY_BYTES):
+        super().__init__(max_bytes)
+
+    def sizeof(self, geometry):
+        return sum(array.nbytes for array in geometry)
+
+    def summary(self):
+        return "geometry cache: {} entries, {} bytes, {} hits, {} misses, {} evictions".format(
+            len(self), self.nbytes, self.hits, self.misses, self.evictions)
+
+
+class DiskFrameCache:
+    """
+    フレームをディスクに保存して再起動後も使えるようにするキャッシュ
+    ファイル名はフレームを決めるすべてのパラメータのハッシュ値
+    """
+
+    # Bump whenever the rasterizer or the frame encoding changes
+    FORMAT_VERSION = 5
+    # Holds the total size shared by every process, so startup doesn't have
+    # to stat every frame. It is also the lock for updating the total.
+    SIZE_FILE = "size"
+    # A process adds its own changes to the size file once they reach this share of max_bytes
+    SAVE_FRACTION = 0.01
+    # A writer renames its temporary file within milliseconds; older ones were left by a crash
+    STALE_SECONDS = 60
+
+    def __init__(self, directory, max_bytes=DEFAULT_DISK_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # Changes made by this process that are not in the size file yet
+        self.pending = 0
+        # Total of all processes as of the last update of the size file, plus
+        # pending; corrected by the directory scan in evict()
+        self.nbytes = 0
+        self.update_size()
+
+    def open_size_file(self):
+        """ サイズファイルを開いてロックした fd を返す (使えなければ None) """
+        try:
+            fd = os.open(os.path.join(self.directory, self.SIZE_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return None
+        try:
+            lock_file(fd)
+        except OSError:
+            # e.g. a network share without locks; the estimate stays per process
+            os.close(fd)
+            return None
+        return fd
+
+    def update_size(self):
+        """ 保留している増減を、ほかのプロセスの分も入ったサイズファイルの合計に足す """
+        fd = self.open_size_file()
+        if fd is None:
+            return
+        try:
+            try:
+                total = int(os.read(fd, 32) or 0)
+            except (OSError, ValueError):
+                # No size file yet: counted from zero until evict() scans
+                total = 0
+            self.write_size(fd, max(0, total + self.pending))
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        """ 終了する前に、まだサイズファイルに足していない増減を足す """
+        if self.pending:
+            self.update_size()
+
+    def write_size(self, fd, total):
+        self.nbytes = total
+        self.pending = 0
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.truncate(fd, 0)
+            os.write(fd, str(total).encode())
+        except OSError:
+            pass
+
+    def digest(self, params):
+        text = repr((self.FORMAT_VERSION, params))
+        import hashlib
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, params):
+        digest = self.digest(params)
+        return os.path.join(self.directory, digest[:2], digest + ".frame")
+
+    def __contains__(self, params):
+        return os.path.exists(self.path(params))
+
+    def get(self, params, size):
+        """ 長さ size のフレームを返す (無い、または壊れている場合は None) """
+        path = self.path(params)
+        try:
+            with open(path, "rb") as f:
+                frame = f.read()
+            # Reads refresh the mtime, which is the eviction order
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        if len(frame) != size:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return frame
+
+    def put(self, params, frame):
+        path = self.path(params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a unique name and rename, so readers in other processes
+        # only ever see complete frames
+        temporary = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            # Overwriting a frame replaces its bytes instead of adding to them
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        try:
+            with open(temporary, "wb") as f:
+                f.write(frame)
+            os.replace(temporary, path)
+        except OSError:
+            return
+        change = len(frame) - replaced
+        self.nbytes += change
+        self.pending += change
+        if self.nbytes > self.max_bytes:
+            self.evict()
+        elif abs(self.pending) >= self.max_bytes * self.SAVE_FRACTION:
+            self.update_size()
+
+    def entries(self, suffixes=(".frame",)):
+        """ 名前が suffixes のどれかで終わるファイルの (path, size, mtime) を列挙する """
+        for bucket in os.scandir(self.directory):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if not entry.name.endswith(suffixes):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """ 古いものから削除して上限の 9 割まで減らす (クラッシュで残った一時ファイルも消す) """
+        # One process evicts at a time; the others wait to add their changes
+        fd = self.open_size_file()
+        try:
+            stale = time.time() - self.STALE_SECONDS
+            entries = []
+            for path, size, mtime in self.entries((".frame", ".tmp")):
+                if path.endswith(".frame"):
+                    entries.append((path, size, mtime))
+                elif mtime < stale:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            entries.sort(key=lambda entry: entry[2])
+            nbytes = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            for path, size, _ in entries:
+                if nbytes <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self.evictions += 1
+                except OSError:
+                    # Already evicted by another process
+                    pass
+                nbytes -= size
+            # The scan counted every process's frames, this one's pending ones too
+            if fd is not None:
+                self.write_size(fd, nbytes)
+            else:
+                self.nbytes = nbytes
+                self.pending = 0
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def summary(self):
+        return "disk cache: {} bytes, {} hits, {} misses, {} evictions".format(
+            self.nbytes, self.hits, self.misses, self.evictions)
+
+
+def lock_file(fd):
+    """ fd をほかのプロセスと排他的にロックする (閉じると外れる) """
+    if os.name == "nt":
+        import msvcrt
+        # Locks the first byte; retries for about 10 seconds, then raises OSError
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        os.lseek(fd, 0, os.SEEK_SET)
+    else:
+        import fcntl
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+
+# After defer_numpy(), frames are drawn without NumPy until the background
+# import started by preload_numpy() has finished
+_numpy_deferred = False
+_numpy_loader = None
+
+
+def defer_numpy():
+    global _numpy_deferred
+    _numpy_deferred = True
+
+
+def preload_numpy():
+    """ NumPy の読み込みを別スレッドで始める (何度呼んでもよい) """
+    global _numpy_loader
+    if _numpy_loader is None:
+        # Touching an attribute runs the deferred import
+        _numpy_loader = threading.Thread(target=getattr, args=(np, "ndarray"), daemon=True)
+        _numpy_loader.start()
+
+
+def numpy_ready():
+    """ NumPy をすぐに使えるか """
+    if not _numpy_deferred:
+        return True
+    return _numpy_loader is not None and not _numpy_loader.is_alive()
+
+
+def wait_for_numpy():
+    if _numpy_deferred:
+        preload_numpy()
+        _numpy_loader.join()
+
+
+def encode_frame(indices):
+    """ 輝度インデックスの配列 (y, x) を端末にそのまま書き込める bytes にする """
+    height, width = indices.shape
+    rows = np.empty((height, width + len(LINE_END)), dtype=np.uint8)
+    rows[:, :width] = np.frombuffer(PALETTE, dtype=np.uint8)[indices]
+    rows[:, width:] = np.frombuffer(LINE_END, dtype=np.uint8)
+    return rows.tobytes()
+
+
+def encode_cells(cells, width):
+    """ encode_frame の標準ライブラリ版 (cells は輝度インデックスを行順に並べた bytes) """
+    text = cells.translate(PALETTE_TABLE)
+    return b"".join(text[start:start + width] + LINE_END for start in range(0, len(text), width))
+
+
+def angle_count(spacing):
+    """ 0 から MAX_RAD までを spacing ごとに標本化したときの角度の数 """
+    return math.floor(MAX_RAD / spacing) + 1
+
+
+def parse_vector(text):
+    """ "0,1,-1" のような指定を3次元ベクトルに変換する """
+    vector = tuple(float(value) for value in text.split(","))
+    if len(vector) != 3 or not any(vector) or not all(math.isfinite(value) for value in vector):
+        raise argparse.ArgumentTypeError("x,y,z の形で0でない有限のベクトルを指定してください")
+    return vector
+
+
+def parse_finite_float(text):
+    """ 有限の数に変換する (nan と inf は受け付けない) """
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("数を指定してください")
+    if not math.isfinite(value):
+        raise argparse.ArgumentTypeError("有限の数を指定してください")
+    return value
+
+
+def parse_non_negative_float(text):
+    """ 0 以上の有限の数に変換する """
+    value = parse_finite_float(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError("0 以上の数を指定してください")
+    return value
+
+
+def parse_positive_float(text):
+    """ 0 より大きい有限の数に変換する """
+    value = parse_finite_float(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("0 より大きい数を指定してください")
+    return value
+
+
+def parse_size(text):
+    """ "80x24" のような指定を (幅, 高さ) に変換する """
+    try:
+        width, height = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("幅x高さ の形で指定してください (例: 80x24)")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("幅と高さは1以上にしてください")
+    return width, height
+
+
+def parse_bytes(text):
+    """ "64M" のようなサイズ指定をバイト数に変換する """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    try:
+        if text and text[-1] in units:
+            size = int(float(text[:-1]) * units[text[-1]])
+        else:
+            size = int(text)
+    except (ValueError, OverflowError):
+        # OverflowError: inf
+        raise argparse.ArgumentTypeError("64M のような大きさを指定してください")
+    if size < 0:
+        raise argparse.ArgumentTypeError("0 以上の大きさを指定してください")
+    return size
+
+
+def rotation_matrix(A, B, C=0):
+    """ Y軸に C, X軸に A, Z軸 (視線方向) に B の順で回転させる行列 """
+    sinA = math.sin(A)
+    cosA = math.cos(A)
+    sinB = math.sin(B)
+    cosB = math.cos(B)
+    sinC = math.sin(C)
+    cosC = math.cos(C)
+    rotate_x = np.array([[1, 0, 0], [0, cosA, -sinA], [0, sinA, cosA]])
+    rotate_y = np.array([[cosC, 0, sinC], [0, 1, 0], [-sinC, 0, cosC]])
+    rotate_z = np.array([[cosB, -sinB, 0], [sinB, cosB, 0], [0, 0, 1]])
+    return rotate_z @ rotate_x @ rotate_y
+
+
+def luminance_index(L):
+    """ 輝度 L (0 < L <= sqrt(2)) を PALETTE のインデックス 1..12 にする """
+    return np.minimum(np.rint(L * 8), 11) + 1
+
+
+def light_vector(light):
+    light = np.asarray(light, dtype=float)
+    return light * (math.sqrt(2) / np.linalg.norm(light))
+
+
+class NullStats:
+    """ 計測しないときに使う何もしない FrameStats """
+    enabled = False
+    show_status = False
+
+    def clock(self):
+        return 0
+
+    def record(self, stage, started):
+        return 0
+
+    def end_frame(self):
+        pass
+
+    def overlay(self, frame, frame_cache, disk_cache=None):
+        return frame
+
+
+NULL_STATS = NullStats()
+
+
+class FrameStats:
+    """
+    描画の段階ごとの所要時間を記録するクラス
+    直近 WINDOW 回の p50/p95/p99 を求め、Chrome の trace event 形式でも書き出せる
+    """
+    enabled = True
+
+    # Samples kept per stage for the rolling percentiles
+    WINDOW = 300
+    # How often the status line text is refreshed, in seconds
+    STATUS_INTERVAL = 0.5
+
+    def __init__(self, show_status=False, trace_events=0):
+        self.show_status = show_status
+        self.samples = {}
+        self.frame_times = collections.deque(maxlen=self.WINDOW)
+        self.start = time.perf_counter()
+        # Only the most recent events are kept so a long run can't run out of memory
+        self.trace = collections.deque(maxlen=trace_events) if trace_events else None
+        self._status = b""
+        self._status_time = 0
+
+    def clock(self):
+        return time.perf_counter()
+
+    def record(self, stage, started):
+        """ started からの経過時間を stage の所要時間として記録し、現在の時刻を返す """
+        now = time.perf_counter()
+        window = self.samples.get(stage)
+        if window is None:
+            window = self.samples[stage] = collections.deque(maxlen=self.WINDOW)
+        window.append(now - started)
+        if self.trace is not None:
+            # Frames may be computed on another thread than they are written
+            self.trace.append((stage, started, now, threading.get_native_id()))
+        return now
+
+    def end_frame(self):
+        now = time.perf_counter()
+        if self.frame_times:
+            self.record("frame", self.frame_times[-1])
+        self.frame_times.append(now)
+
+    def percentiles(self, stage):
+        """ stage の直近の p50, p95, p99 (秒) """
+        times = sorted(self.samples[stage])
+        last = len(times) - 1
+        return tuple(times[round(last * q)] for q in (0.5, 0.95, 0.99))
+
+    def fps(self):
+        if len(self.frame_times) < 2:
+            return 0
+        return (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+
+    @staticmethod
+    def hit_rates(frame_cache, disk_cache=None):
+        """ フレームの取得のうちメモリと、メモリに無くディスクにあった割合 (memory, disk) """
+        lookups = frame_cache.hits + frame_cache.misses
+        if not lookups:
+            return 0, 0
+        # Every disk lookup follows a miss in memory
+        disk_hits = disk_cache.hits if disk_cache is not None else 0
+        return frame_cache.hits / lookups, disk_hits / lookups
+
+    def status_line(self, frame_cache, disk_cache=None):
+        # A copy: another thread may add a stage meanwhile
+        stages = " ".join("{} {:.1f}".format(stage, self.percentiles(stage)[1] * 1000)
+                          for stage in list(self.samples) if stage != "frame")
+        memory, disk = self.hit_rates(frame_cache, disk_cache)
+        return "{:.1f} fps | hit mem {:.0%} disk {:.0%} | p95 ms: {}".format(
+            self.fps(), memory, disk, stages)
+
+    def overlay(self, frame, frame_cache, disk_cache=None):
+        """ frame の最後の行をステータス行に置き換えたものを返す """
+        if not self.show_status:
+            return frame
+        now = time.perf_counter()
+        if now - self._status_time >= self.STATUS_INTERVAL:
+            self._status = self.status_line(frame_cache, disk_cache).encode("ascii", "replace")
+            self._status_time = now
+
+        start = frame.rfind(LINE_END, 0, len(frame) - len(LINE_END)) + len(LINE_END)
+        width = len(frame) - start - len(LINE_END)
+        if width <= 0:
+            return frame
+        return frame[:start] + self._status[:width].ljust(width) + frame[start + width:]
+
+    def summary(self, frame_cache, disk_cache=None):
+        memory, disk = self.hit_rates(frame_cache, disk_cache)
+        lines = ["stats: {:.1f} fps, cache hit rate {:.1%} (memory {:.1%}, disk {:.1%})".format(
+            self.fps(), memory + disk, memory, disk)]
+        for stage in self.samples:
+            lines.append("  {:<10} p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms".format(
+                stage, *(value * 1000 for value in self.percentiles(stage))))
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        """ 記録したイベントを Chrome の trace event 形式 (chrome://tracing, Perfetto) で保存する """
+        pid = os.getpid()
+        events = [{"name": stage, "cat": "frame", "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (started - self.start) * 1e6, "dur": (ended - started) * 1e6}
+                  for stage, started, ended, tid in self.trace or ()]
+        import json
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _rasterize_samples(u, v, ooz, normals, cosB, sinB, light, xcenter, ycenter, zbuffer, indices):
+    """
+    rasterize の turn, project, z-buffer を1点ずつ行うループ (NumbaBackend が JIT コンパイルする)
+    輝度インデックスを indices に書き込み、(暗い点, 画面外の点) の数を返す
+    """
+    lx, ly, lz = light
+    height, width = indices.shape
+    unlit = 0
+    offscreen = 0
+    for i in range(len(ooz)):
+        # Same expressions as project(), so both round the same way
+        L = (cosB * lx + sinB * ly) * normals[0, i] + (cosB * ly - sinB * lx) * normals[1, i] + lz * normals[2, i]
+        if L <= 0:
+            unlit += 1
+            continue
+        xpos = xcenter + int(np.rint(2 * (cosB * u[i] - sinB * v[i])))
+        ypos = ycenter - int(np.rint(sinB * u[i] + cosB * v[i]))
+        if xpos < 0 or xpos >= width or ypos < 0 or ypos >= height:
+            offscreen += 1
+            continue
+        # Strictly nearer, so the earliest sample wins a tie like in project()
+        if ooz[i] > zbuffer[ypos, xpos]:
+            zbuffer[ypos, xpos] = ooz[i]
+            indices[ypos, xpos] = int(min(np.rint(L * 8), 11)) + 1
+    return unlit, offscreen
+
+
+# _rasterize_samples compiled by Numba, once per process
+_numba_kernel = None
+
+
+class Backend(object, metaclass=abc.ABCMeta):
+    """ フレームの輝度インデックスを計算する方法 (--backend で選ぶ) """
+
+    name = None
+    # Whether compute_frame() has to wait for the NumPy import
+    needs_numpy = True
+
+    def available(self):
+        """ 必要なライブラリがインストールされているか """
+        return True
+
+    def supports(self, obj):
+        """ obj のフレームを計算できるか """
+        return True
+
+    @abc.abstractmethod
+    def rasterize(self, obj, A, B, C=0):
+        """ 輝度インデックスを計算する (encode() に渡す形で返す) """
+        pass
+
+    def encode(self, obj, indices):
+        return encode_frame(indices)
+
+    def frame(self, obj, A, B, C=0):
+        """ エンコード済みのフレームを計算する (キャッシュは使わない) """
+        return self.encode(obj, self.rasterize(obj, A, B, C))
+
+    def worker_backend(self):
+        """ obj をワーカープロセスに渡したときにそちらで使うバックエンド """
+        return self
+
+    def close(self):
+        """ 起動したプロセスなどを片付ける """
+        pass
+
+
+class ReferenceBackend(Backend):
+    """ 1点ずつ計算する純粋な Python の参照実装 (NumPy を使わない) """
+
+    name = "reference"
+    needs_numpy = False
+
+    def supports(self, obj):
+        # The reference loop has the default light built in
+        return hasattr(obj, "rasterize_reference") and tuple(obj.light) == LIGHT
+
+    def rasterize(self, obj, A, B, C=0):
+        if C:
+            # The reference loop only turns about X and Z. NumPy may still be
+            # importing on another thread, and that import is not thread-safe.
+            wait_for_numpy()
+            return obj.rasterize(A, B, C).tobytes()
+        return obj.rasterize_reference(A, B, cull=True)
+
+    def encode(self, obj, indices):
+        return encode_cells(indices, obj.screen_width)
+
+
+class NumPyBackend(Backend):
+    """ 点群をまとめて回転・投影する NumPy の実装 """
+
+    name = "numpy"
+
+    def rasterize(self, obj, A, B, C=0):
+        return obj.rasterize(A, B, C)
+
+
+class NumbaBackend(Backend):
+    """ 回転は NumPy で行い、投影と z-buffer を Numba で JIT コンパイルしたループで行う実装 """
+
+    name = "numba"
+
+    def available(self):
+        return importlib.util.find_spec("numba") is not None
+
+    def supports(self, obj):
+        # Objects with a rasterize() of their own (Scene) are left to NumPy
+        return type(obj).rasterize is ThreeDimensionalObject.rasterize
+
+    @staticmethod
+    def kernel():
+        global _numba_kernel
+        if _numba_kernel is None:
+            import numba
+            # cache=True keeps the compiled code on disk for later runs
+            _numba_kernel = numba.njit(cache=True, nogil=True)(_rasterize_samples)
+        return _numba_kernel
+
+    def rasterize(self, obj, A, B, C=0):
+        u, v, ooz, normals = obj.geometry(A, C)
+        indices = np.zeros((obj.screen_height, obj.screen_width), dtype=np.uint8)
+        zbuffer = np.zeros(indices.shape)
+        unlit, offscreen = self.kernel()(u, v, ooz, normals, math.cos(B), math.sin(B),
+                                         tuple(light_vector(obj.light)), round(obj.screen_width / 2),
+                                         round(obj.screen_height / 2), zbuffer, indices)
+        samples = obj.get_surface().shape[1] // 2
+        obj.culled.update(samples=samples, back=samples - len(ooz), unlit=unlit, offscreen=offscreen)
+        return indices
+
+
+# --backend choices; auto times them in this order, so a slow one is cut short.
+# SplitBackend (--split) is not one of them.
+BACKENDS = {backend.name: backend for backend in (NumPyBackend(), NumbaBackend(), ReferenceBackend())}
+
+
+def calibrate_backends(obj, backends, frames=CALIBRATION_FRAMES):
+    """ backends それぞれで obj を数フレーム計算し、1フレームあたりの最短の秒数を名前ごとに返す """
+    wait_for_numpy()
+    caches = obj.geometry_caches()
+    budgets = [cache.max_bytes for cache in caches]
+    timings = {}
+    try:
+        # Time geometry misses, which most frames are, and keep nothing
+        for cache in caches:
+            cache.max_bytes = 0
+        for backend in backends:
+            # The first call builds the surface (and compiles a JIT kernel)
+            backend.rasterize(obj, 0.5, 0.5)
+            best = math.inf
+            for index in range(frames):
+                angle = 1 + 0.77 * index
+                started = time.perf_counter()
+                backend.rasterize(obj, angle, angle)
+                best = min(best, time.perf_counter() - started)
+                if best > min(timings.values(), default=math.inf):
+                    # Already slower than another backend at its best
+                    break
+            timings[backend.name] = best
+    finally:
+        for cache, budget in zip(caches, budgets):
+            cache.max_bytes = budget
+        obj.culled.clear()
+    return timings
+
+
+class BackendChoices:
+    """ --backend auto で選んだバックエンドを、環境と画面の組み合わせごとにファイルに残すクラス """
+
+    def __init__(self, path):
+        import json
+        self.path = path
+        try:
+            with open(path) as f:
+                self.choices = json.load(f)
+        except (OSError, ValueError):
+            self.choices = {}
+
+    @staticmethod
+    def key(obj, backends):
+        # Everything that can change which backend is the fastest
+        import platform
+        return repr((platform.machine(), platform.python_implementation(), sys.version_info[:2],
+                     type(obj).__name__, obj.cache_params(), obj.screen_width, obj.screen_height,
+                     sorted(backend.name for backend in backends)))
+
+    def get(self, key):
+        return self.choices.get(key)
+
+    def put(self, key, name):
+        import json
+        self.choices[key] = name
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Written aside and renamed, so a concurrent run never reads half a file
+            temporary = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(temporary, "w") as f:
+                json.dump(self.choices, f, indent=1)
+            os.replace(temporary, self.path)
+        except OSError:
+            # The choice is only remembered; timing again next run is fine
+            pass
+
 
 class ThreeDimensionalObject(object, metaclass=abc.ABCMeta):
     """ 3Dオブジェクトを計算するクラス """
 
+    def __init__(self, frame_cache=None, disk_cache=None, geometry_cache=None):
+        if frame_cache is None:
+            frame_cache = FrameCache()
+        if geometry_cache is None:
+            geometry_cache = GeometryCache()
+        self.frame_cache = frame_cache
+        self.disk_cache = disk_cache
+        self.geometry_cache = geometry_cache
+        # Samples seen by project() and how many each culling step dropped
+        self.culled = collections.Counter()
+
+    def __getstate__(self):
+        # Worker processes only rasterize; don't ship the caches
+        state = self.__dict__.copy()
+        state["frame_cache"] = None
+        state["disk_cache"] = None
+        # Each worker fills a geometry cache of its own
+        state["geometry_cache"] = GeometryCache(self.geometry_cache.max_bytes)
+        # Timings are only collected in the main process
+        state.pop("stats", None)
+        # A backend running processes of its own stays in this one
+        if "backend" in state:
+            state["backend"] = state["backend"].worker_backend()
+        return state
+
+    def frame_key(self, A, B, C=0):
+        # The animation steps through the same angles every cycle, so the
+        # exact angles are the key. Frames of every screen size share the
+        # cache, so going back to an earlier size finds its frames again.
+        return (self.screen_width, self.screen_height, float(A), float(B), float(C))
+
+    def frame_bytes(self):
+        """ エンコードしたフレーム1枚のバイト数 """
+        return self.screen_height * (self.screen_width + len(LINE_END))
+
     @abc.abstractmethod
-    def compute_frame(self, A, B):
-        """ 最大2軸方向への計算が可能 """
+    def cache_params(self):
+        """ 形状と標本化の間隔など、フレームを決めるパラメータ """
         pass
 
+    def disk_key(self, key):
+        # Everything the frame depends on besides the angles
+        return (type(self).__name__, self.cache_params(), self.K1, tuple(self.light),
+                LINE_END, key)
+
+    def has_frame(self, key):
+        if key in self.frame_cache:
+            return True
+        return self.disk_cache is not None and self.disk_key(key) in self.disk_cache
+
+    def cached_frame(self, key):
+        output = self.frame_cache.get(key)
+        if output is None and self.disk_cache is not None:
+            output = self.disk_cache.get(self.disk_key(key), self.frame_bytes())
+            if output is not None:
+                self.frame_cache.put(key, output)
+        return output
+
+    def store_frame(self, key, output):
+        self.frame_cache.put(key, output)
+        if self.disk_cache is not None:
+            self.disk_cache.put(self.disk_key(key), output)
+
+    def compute_frame(self, A, B, C=0):
+        """ エンコード済みのフレームを返す (キャッシュがあればそれを使う) """
+        stats = self.stats
+        started = stats.clock()
+        key = self.frame_key(A, B, C)
+        output = self.cached_frame(key)
+        started = stats.record("cache", started)
+        if output is not None:
+            return output
+
+        backend = self.backend
+        if backend.needs_numpy and not numpy_ready():
+            # NumPy is still loading in the background; draw without it if we can
+            output = self.frame_without_numpy(A, B, C)
+            if output is not None:
+                # Not cached: it may differ from rasterize() in a rounding tie
+                stats.record("rasterize", started)
+                return output
+            wait_for_numpy()
+
+        indices = backend.rasterize(self, A, B, C)
+        started = stats.record("rasterize", started)
+        output = backend.encode(self, indices)
+        started = stats.record("encode", started)
+
+        # Store result
+        self.store_frame(key, output)
+        stats.record("store", started)
+        return output
+
+    # Per-stage timings (FrameStats when --stats is on)
+    stats = NULL_STATS
+
+    # How frames are rasterized (--backend)
+    backend = BACKENDS["numpy"]
+
+    # Distance between screen and eye
+    K2 = 5
+
+    # Projection scale; fit_to_screen() derives it from the terminal size
+    K1 = K1
+
+    # Size of the screen the frames are drawn for; set by fit_to_screen()
+    screen_width = SCREEN_WIDTH
+    screen_height = SCREEN_HEIGHT
+
+    light = LIGHT
+
+    # Positions and normals side by side in one (3, 2N) array, so a single
+    # matrix product rotates both
+    _surface = None
+
+    def get_obj(self):
+        """ 表面の点の位置と法線を (x, y, z) ごとの配列で返す """
+        surface = self.get_surface()
+        count = surface.shape[1] // 2
+        return surface[:, :count], surface[:, count:]
+
+    def get_surface(self):
+        """ 位置と法線を並べた (3, 2N) の配列を返す (一度だけ計算する) """
+        if self._surface is None:
+            positions, normals = self.build_points()
+            self._surface = np.concatenate([positions, normals], axis=1)
+        return self._surface
+
+    def keep_samples(self, start, stop):
+        """ start 番目から stop 番目の手前までの標本点だけを残す (SplitBackend のプロセスが使う) """
+        surface = self.get_surface()
+        count = surface.shape[1] // 2
+        self._surface = np.concatenate([surface[:, start:stop], surface[:, count + start:count + stop]],
+                                       axis=1)
+        self.geometry_cache = GeometryCache(self.geometry_cache.max_bytes)
+
+    @abc.abstractmethod
+    def bounding_radius(self):
+        """ 原点を中心とし、物体全体を含む球の半径 """
+        pass
+
+    @abc.abstractmethod
+    def set_sample_spacing(self, pitch):
+        """ 表面上で隣り合う標本点の距離が pitch 以下になるように間隔を決める """
+        pass
+
+    def fit_to_screen(self, width, height, k1=None, lod=1.0, depth=0):
+        """
+        画面の大きさから投影の倍率 K1 と標本化の細かさを決める
+        k1 を指定するとその倍率を使い、lod が 0 以下ならクラスの間隔のままにする
+        depth はシーンの中で中心を奥へずらした距離
+        """
+        self.screen_width = width
+        self.screen_height = height
+        params = (self.K1, self.cache_params())
+        radius = self.bounding_radius()
+        if k1 is None:
+            # A row is about twice as tall as a column is wide
+            k1 = min(height * self.K2 / radius, width * self.K2 / (2 * radius)) * SCREEN_FILL
+        self.K1 = k1
+
+        if lod > 0:
+            # Width of one column at the nearest depth the surface can reach,
+            # in object units. Samples closer than this land in the same cell.
+            pitch = (self.K2 + depth - radius) / k1 / lod
+            if not 0 < pitch < math.inf:
+                raise ValueError("sample pitch must be positive and finite, got {}".format(pitch))
+            self.set_sample_spacing(pitch)
+
+        if (self.K1, self.cache_params()) != params:
+            self._surface = None
+
+    def frame_without_numpy(self, A, B, C=0):
+        """ NumPy を使わずに計算したエンコード済みのフレーム (できないときは None) """
+        return None
+
+    def geometry_caches(self):
+        return [self.geometry_cache]
+
+    def cull_counts(self):
+        return self.culled
+
+    def cull_summary(self):
+        counts = self.cull_counts()
+        samples = counts["samples"] or 1
+        return "culling: {} samples, {:.0%} back-facing, {:.0%} unlit, {:.0%} off screen".format(
+            counts["samples"], counts["back"] / samples, counts["unlit"] / samples,
+            counts["offscreen"] / samples)
+
+    @abc.abstractmethod
+    def build_points(self):
+        """ (positions, normals) をそれぞれ (3, N) の配列で返す """
+        pass
+
+    def geometry(self, A, C=0, position=(0, 0, 0)):
+        """
+        A と C だけで回転させ、中心を position に置いた点群を返す
+        B は視線方向の回転なので奥行きを変えず、この結果をすべての B で使い回せる
+        """
+        key = self.frame_key(A, 0, C) + tuple(position)
+        geometry = self.geometry_cache.get(key)
+        if geometry is not None:
+            return geometry
+
+        surface = self.get_surface()
+        count = surface.shape[1] // 2
+        rotated = rotation_matrix(A, 0, C) @ surface
+        x, y, z = rotated[:, :count]
+        nx, ny, nz = rotated[:, count:]
+        px, py, pz = position
+
+        # Back-face culling: drop samples whose normal points away from the
+        # eye, n . (point - eye) > 0. Turning by B keeps that product unless
+        # the centre is off the view axis; then only samples facing away at
+        # every B are dropped here and project() checks the rest.
+        facing = nx * x + ny * y + nz * (z + pz + self.K2)
+        if px or py:
+            facing -= np.hypot(nx, ny) * math.hypot(px, py)
+        front = np.flatnonzero(facing <= 0)
+        x = x[front]
+        y = y[front]
+        z = z[front]
+
+        # compute zpos ^ -1
+        ooz = 1 / (z + pz + self.K2)
+
+        # Half the projected screen offsets (a row is two columns tall)
+        scale = (self.K1 / 2) * ooz
+        geometry = (scale * x, scale * y, ooz, rotated[:, count:][:, front])
+        if px or py:
+            # B turns the object about its own centre, so the shift of the
+            # centre is kept apart and added after the turn
+            geometry += (scale * px, scale * py)
+        self.geometry_cache.put(key, geometry)
+        return geometry
+
+    def project(self, A, B, C=0, position=(0, 0, 0)):
+        """ 点が当たるセルごとに、一番手前の点の (セル番号, ooz, 輝度 L) を返す """
+        u, v, ooz, normals, *shift = self.geometry(A, C, position)
+        sinB = math.sin(B)
+        cosB = math.cos(B)
+        samples = self.get_surface().shape[1] // 2
+        culled = self.culled
+        culled["samples"] += samples
+        culled["back"] += samples - len(ooz)
+
+        # Luminance (L <= sqrt(2)): turning the normals by B is the same as
+        # turning the light by -B
+        lx, ly, lz = light_vector(self.light)
+        nx, ny, nz = normals
+        L = (cosB * lx + sinB * ly) * nx + (cosB * ly - sinB * lx) * ny + lz * nz
+        keep = L > 0
+        culled["unlit"] += len(L) - int(np.count_nonzero(keep))
+        if shift:
+            # The exact back-face test for this B, scaled by (K1 / 2) * ooz
+            back = (nx * u + ny * v + (self.K1 / 2) * nz
+                    + (cosB * nx - sinB * ny) * shift[0] + (sinB * nx + cosB * ny) * shift[1]) > 0
+            culled["back"] += int(np.count_nonzero(back))
+            culled["unlit"] -= int(np.count_nonzero(back & ~keep))
+            keep &= ~back
+
+        # Only the lit, front-facing samples are projected
+        keep = np.flatnonzero(keep)
+        u = u[keep]
+        v = v[keep]
+        ooz = ooz[keep]
+        L = L[keep]
+
+        # Turn the projected points about the view axis
+        xdash = 2 * (cosB * u - sinB * v)
+        ydash = sinB * u + cosB * v
+        if shift:
+            xdash += 2 * shift[0][keep]
+            ydash += shift[1][keep]
+        xpos = round((self.screen_width) / 2) + np.rint(xdash).astype(np.intp)
+        ypos = round((self.screen_height) / 2) - np.rint(ydash).astype(np.intp)
+
+        # Clip to the screen
+        visible = ((xpos >= 0) & (xpos < self.screen_width)
+                   & (ypos >= 0) & (ypos < self.screen_height))
+        cells = (ypos * self.screen_width + xpos)[visible]
+        ooz = ooz[visible]
+        L = L[visible]
+        culled["offscreen"] += len(visible) - len(cells)
+
+        # Z-buffer: group the samples by cell with a stable sort, then keep
+        # the one with the largest ooz in every run. On ties the earliest
+        # sample wins as in the loop.
+        if self.screen_width * self.screen_height <= 1 << 16:
+            # Small enough for NumPy's radix sort
+            cells = cells.astype(np.uint16)
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        ooz = ooz[order]
+        starts = np.ones(len(cells), dtype=bool)
+        starts[1:] = cells[1:] != cells[:-1]
+        run = np.cumsum(starts) - 1
+        nearest = np.flatnonzero(ooz == np.maximum.reduceat(ooz, np.flatnonzero(starts))[run])
+        first = np.ones(len(nearest), dtype=bool)
+        first[1:] = run[nearest[1:]] != run[nearest[:-1]]
+        nearest = nearest[first]
+        return cells[nearest], ooz[nearest], L[order[nearest]]
+
+    def rasterize(self, A, B, C=0):
+        """ A: X軸, B: Z軸, C: Y軸 で回転させた輝度インデックスの配列 (y, x) を計算する """
+        cells, _, L = self.project(A, B, C)
+        indices = np.zeros((self.screen_height, self.screen_width), dtype=np.uint8)
+        indices.reshape(-1)[cells] = luminance_index(L)
+        return indices
+
+
+class Cube(ThreeDimensionalObject):
+    # Half the length of an edge
+    size = 1.5
+
+    spacing = 0.06
+
+    def cache_params(self):
+        return (self.size, self.K2, self.spacing)
+
+    def bounding_radius(self):
+        return self.size * math.sqrt(3)
+
+    def set_sample_spacing(self, pitch):
+        # 6 faces of (2 * size / pitch) ** 2 samples
+        self.spacing = max(pitch, 2 * self.size * math.sqrt(6 / MAX_SAMPLES))
+
+    def build_points(self):
+        steps = np.arange(-self.size, self.size + self.spacing / 2, self.spacing)
+        u, v = np.meshgrid(steps, steps, indexing="ij")
+        u = u.reshape(-1)
+        v = v.reshape(-1)
+        side = np.full(len(u), self.size)
+        zero = np.zeros(len(u))
+        one = np.ones(len(u))
+
+        positions = []
+        normals = []
+        # Each face: the fixed axis at +size or -size, normal pointing outwards
+        for axis in range(3):
+            for sign in (1, -1):
+                position = [u, v]
+                position.insert(axis, sign * side)
+                normal = [zero, zero]
+                normal.insert(axis, sign * one)
+                positions.append(position)
+                normals.append(normal)
+        return np.concatenate(positions, axis=1), np.concatenate(normals, axis=1)
+
 
 class Donut(ThreeDimensionalObject):
     # Small circle radius
@@ -28,26 +1187,118 @@ class Donut(ThreeDimensionalObject):
     # Big circle radius
     R2 = 2
 
-    # Distance between screen and eye
-    K2 = 5
-
     theta_spacing = 0.07
     phi_spacing = 0.02
 
-    screen_notes = [[None for i in range(int(MAX_RAD * 100) + 1)]
-                    for j in range(int(MAX_RAD * 100) + 1)]
+    def cache_params(self):
+        return (self.R1, self.R2, self.K2, self.theta_spacing, self.phi_spacing)
+
+    def bounding_radius(self):
+        return self.R1 + self.R2
+
+    def set_sample_spacing(self, pitch):
+        # theta walks the small circle, phi the largest circle of the ring
+        pitch = max(pitch, MAX_RAD * math.sqrt(self.R1 * (self.R1 + self.R2) / MAX_SAMPLES))
+        self.theta_spacing = pitch / self.R1
+        self.phi_spacing = pitch / (self.R1 + self.R2)
+
+    def build_points(self):
+        # index * spacing, exactly like the reference loop
+        thetas = np.arange(angle_count(self.theta_spacing)) * self.theta_spacing
+        phis = np.arange(angle_count(self.phi_spacing)) * self.phi_spacing
+
+        theta, phi = np.meshgrid(thetas, phis, indexing="ij")
+        sintheta = np.sin(theta.reshape(-1))
+        costheta = np.cos(theta.reshape(-1))
+        sinphi = np.sin(phi.reshape(-1))
+        cosphi = np.cos(phi.reshape(-1))
 
-    def compute_frame(self, A, B):
-        """ A: X軸, B: Y軸 """
-        note_a = int(A * 100)
-        note_b = int(B * 100)
-        if not (self.screen_notes[note_a][note_b] is None):
-            return self.screen_notes[note_a][note_b]
+        # The circle (R2 + R1 cos(theta), R1 sin(theta)) swept around the Y axis
+        circlex = self.R2 + self.R1 * costheta
+        circley = self.R1 * sintheta
+        positions = np.array([circlex * cosphi, circley, circlex * sinphi])
+        normals = np.array([costheta * cosphi, sintheta, costheta * sinphi])
+        return positions, normals
 
+    def frame_without_numpy(self, A, B, C=0):
+        # Same sampling as rasterize_reference, with everything that depends
+        # on one angle alone hoisted out of the inner loop
+        if C or tuple(self.light) != LIGHT:
+            return None
+        width = self.screen_width
+        height = self.screen_height
+        zbuffer = [0.0] * (width * height)
+        output = bytearray(width * height)
+
+        sinA = math.sin(A)
+        cosA = math.cos(A)
+        sinB = math.sin(B)
+        cosB = math.cos(B)
+        thetas, phis = self.sample_angles()
+        # Per-phi factors of x, y, z and the luminance
+        factors = [(cosB * cosphi + sinA * sinB * sinphi,
+                    cosphi * sinB - cosB * sinA * sinphi,
+                    cosA * sinphi,
+                    cosphi * sinB - cosA * sinphi - cosB * sinA * sinphi)
+                   for sinphi, cosphi in phis]
+
+        K1 = self.K1
+        K2 = self.K2
+        xcenter = round(width / 2)
+        ycenter = round(height / 2)
+        for sintheta, costheta in thetas:
+            circlex = self.R2 + self.R1 * costheta
+            circley = self.R1 * sintheta
+            xoffset = circley * cosA * sinB
+            yoffset = circley * cosA * cosB
+            zoffset = circley * sinA
+            lightoffset = sintheta * (cosA * cosB - sinA)
+            # The normal is the position with R1 = 1 and R2 = 0
+            nxoffset = sintheta * cosA * sinB
+            nyoffset = sintheta * cosA * cosB
+            nzoffset = sintheta * sinA
+            for xfactor, yfactor, zfactor, lightfactor in factors:
+                L = costheta * lightfactor + lightoffset
+                if L <= 0:
+                    continue
+                x = circlex * xfactor - xoffset
+                y = circlex * yfactor + yoffset
+                zpos = circlex * zfactor + zoffset + K2
+                # Back-face culling
+                if ((costheta * xfactor - nxoffset) * x + (costheta * yfactor + nyoffset) * y
+                        + (costheta * zfactor + nzoffset) * zpos > 0):
+                    continue
+                ooz = 1 / zpos
+                xpos = xcenter + round(K1 * x * ooz)
+                ypos = ycenter - round((K1 / 2) * y * ooz)
+                if 0 <= xpos < width and 0 <= ypos < height:
+                    cell = ypos * width + xpos
+                    if ooz > zbuffer[cell]:
+                        zbuffer[cell] = ooz
+                        output[cell] = round(L * 8) + 1
+        return encode_cells(output, width)
+
+    def sample_angles(self):
+        """ 標本化する theta と phi の (sin, cos) の一覧 (rasterize_reference と同じ角度) """
+        angles = []
+        for spacing in (self.theta_spacing, self.phi_spacing):
+            angles.append([(math.sin(index * spacing), math.cos(index * spacing))
+                           for index in range(angle_count(spacing))])
+        return angles
+
+    def rasterize_reference(self, A, B, cull=False, back_faces=None):
+        """
+        1点ずつ計算する参照実装 (rasterize の検証と --backend reference に使う)
+        輝度インデックスを行順に並べた bytearray を返す
+        cull が真なら rasterize と同じく裏を向いた標本点を描かない
+        back_faces (長さ width * height の bytearray) には、裏を向いた標本点が勝ったセルに 1 を書く
+        """
+        width = self.screen_width
+        height = self.screen_height
         # zbuffer
-        zbuffer = np.zeros((SCREEN_WIDTH, SCREEN_HEIGHT))
-        # screen contents
-        output = np.full((SCREEN_WIDTH, SCREEN_HEIGHT), ' ')
+        zbuffer = [0.0] * (width * height)
+        # screen contents (luminance index + 1, 0 = empty)
+        output = bytearray(width * height)
 
         # Precompute
         sinA = math.sin(A)
@@ -55,16 +1306,16 @@ class Donut(ThreeDimensionalObject):
         sinB = math.sin(B)
         cosB = math.cos(B)
 
-        theta = 0
-        while theta <= MAX_RAD:
+        for theta_index in range(angle_count(self.theta_spacing)):
+            theta = theta_index * self.theta_spacing
             # Precompute
             sintheta = math.sin(theta)
             costheta = math.cos(theta)
             circlex = self.R2 + self.R1 * costheta
             circley = self.R1 * sintheta
 
-            phi = 0
-            while phi <= MAX_RAD:
+            for phi_index in range(angle_count(self.phi_spacing)):
+                phi = phi_index * self.phi_spacing
                 # Precompute
                 sinphi = math.sin(phi)
                 cosphi = math.cos(phi)
@@ -81,175 +1332,1506 @@ class Donut(ThreeDimensionalObject):
                 ooz = 1 / zpos
 
                 # Compute xdash, ydash(scree上においての座標)
-                xdash = round(K1 * x * ooz)
-                ydash = round((K1 / 2) * y * ooz)
+                xdash = round(self.K1 * x * ooz)
+                ydash = round((self.K1 / 2) * y * ooz)
 
                 # Compute x position, y position
                 # xpos = (screen_width) / 2, ypos = (screen_height) / 2
-                xpos = round((SCREEN_WIDTH) / 2) + xdash
-                ypos = round((SCREEN_HEIGHT) / 2) - ydash
+                xpos = round((width) / 2) + xdash
+                ypos = round((height) / 2) - ydash
 
                 # Compute luminance(L <= sqrt(2))
-                L = cosphi * costheta * sinB - cosA * costheta * sinphi - sinA * sintheta
-                + cosB * (cosA * sintheta - costheta * sinA * sinphi)
+                L = (cosphi * costheta * sinB - cosA * costheta * sinphi - sinA * sintheta
+                     + cosB * (cosA * sintheta - costheta * sinA * sinphi))
+
+                # Compute the normal (x, y, z with R1 = 1, R2 = 0)
+                nx = costheta * (cosB * cosphi + sinA * sinB * sinphi) - sintheta * cosA * sinB
+                ny = costheta * (cosphi * sinB - cosB * sinA * sinphi) + sintheta * cosA * cosB
+                nz = cosA * costheta * sinphi + sintheta * sinA
+
+                # Seen from behind (normal pointing away from the eye)
+                back = nx * x + ny * y + nz * zpos > 0
 
                 # Seek display character
-                if L > 0 and ooz > zbuffer[xpos][ypos]:
-                    zbuffer[xpos][ypos] = ooz
+                cell = ypos * width + xpos
+                if (L > 0 and not (cull and back) and 0 <= xpos < width and 0 <= ypos < height
+                        and ooz > zbuffer[cell]):
+                    zbuffer[cell] = ooz
                     luminance_index = round(L * 8)
-                    output[xpos][ypos] = ".,-~:;=!*#$@"[luminance_index]
+                    output[cell] = luminance_index + 1
+                    if back_faces is not None:
+                        back_faces[cell] = back
 
-                phi += self.phi_spacing
-            theta += self.theta_spacing
+        return output
 
-        # Store result
-        self.screen_notes[note_a][note_b] = output
+
+class Scene(ThreeDimensionalObject):
+    """
+    複数のオブジェクトを1つの z-buffer に描くクラス
+    オブジェクトごとに位置 (x, y, z) と回転の速さの倍率 spin を持つ
+    """
+
+    def __init__(self, entries, frame_cache=None, disk_cache=None, geometry_cache=None):
+        """ entries は (オブジェクト, 位置, spin) のリスト """
+        super().__init__(frame_cache, disk_cache, geometry_cache)
+        # Nearest first, so the occlusion test sees what is in front
+        self.entries = sorted(((obj, tuple(position), tuple(spin)) for obj, position, spin in entries),
+                              key=lambda entry: entry[1][2])
+        # The scene has no points of its own; the members share its budget
+        for obj, _, _ in self.entries:
+            obj.geometry_cache = GeometryCache(self.geometry_cache.max_bytes // len(self.entries))
+        self.drawn = 0
+        self.offscreen = 0
+        self.hidden = 0
+
+    @classmethod
+    def row(cls, objects, frame_cache=None, disk_cache=None, geometry_cache=None):
+        """ objects を横一列に並べ、隣どうしを逆向きに回すシーン """
+        gap = 2.2 * max(obj.bounding_radius() for obj in objects)
+        count = len(objects)
+        # Push the row back as it grows so the ends are not seen from too close
+        depth = gap * (count - 1) / 2
+        entries = [(obj, ((index - (count - 1) / 2) * gap, 0, depth), (1, 1, 1) if index % 2 == 0 else (-1, -1, -1))
+                   for index, obj in enumerate(objects)]
+        return cls(entries, frame_cache, disk_cache, geometry_cache)
+
+    def cache_params(self):
+        return tuple((type(obj).__name__, obj.cache_params(), position, spin)
+                     for obj, position, spin in self.entries)
+
+    def bounding_radius(self):
+        return max(math.hypot(*position) + obj.bounding_radius() for obj, position, _ in self.entries)
+
+    def set_sample_spacing(self, pitch):
+        # Every member is sampled for its own depth in fit_to_screen()
+        pass
+
+    def build_points(self):
+        raise NotImplementedError("a scene is drawn from the points of its members")
+
+    def geometry_caches(self):
+        return [obj.geometry_cache for obj, _, _ in self.entries]
+
+    def cull_counts(self):
+        return sum((obj.culled for obj, _, _ in self.entries), collections.Counter())
+
+    def fit_to_screen(self, width, height, k1=None, lod=1.0, depth=0):
+        self.screen_width = width
+        self.screen_height = height
+        if k1 is None:
+            # Largest offset from the centre of the screen, per unit of K1
+            reach_x = max((abs(x) + obj.bounding_radius()) / (self.K2 + z)
+                          for obj, (x, _, z), _ in self.entries)
+            reach_y = max((abs(y) + obj.bounding_radius()) / (self.K2 + z)
+                          for obj, (_, y, z), _ in self.entries)
+            k1 = min(width / 2 / reach_x, height / reach_y) * SCREEN_FILL
+        self.K1 = k1
+        for obj, position, _ in self.entries:
+            # The members are lit and projected like the scene
+            obj.light = self.light
+            obj.fit_to_screen(width, height, k1, lod, depth + position[2])
+
+    def screen_bounds(self, obj, position):
+        """ オブジェクトの外接球が画面上で占める範囲 (x0, x1, y0, y1)、画面外なら None """
+        x, y, z = position
+        radius = obj.bounding_radius()
+        near = self.K2 + z - radius
+        if near <= 0:
+            # Reaches behind the eye; can't be bounded, so never culled
+            return 0, self.screen_width, 0, self.screen_height
+        far = near + 2 * radius
+        left = min((x - radius) / near, (x - radius) / far) * self.K1
+        right = max((x + radius) / near, (x + radius) / far) * self.K1
+        top = max((y + radius) / near, (y + radius) / far) * self.K1 / 2
+        bottom = min((y - radius) / near, (y - radius) / far) * self.K1 / 2
+        x0 = max(round(self.screen_width / 2) + math.floor(left) - 1, 0)
+        x1 = min(round(self.screen_width / 2) + math.ceil(right) + 2, self.screen_width)
+        y0 = max(round(self.screen_height / 2) - math.ceil(top) - 1, 0)
+        y1 = min(round(self.screen_height / 2) - math.floor(bottom) + 2, self.screen_height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, x1, y0, y1
+
+    def rasterize(self, A, B, C=0):
+        width = self.screen_width
+        height = self.screen_height
+        zbuffer = np.zeros((height, width))
+        indices = np.zeros((height, width), dtype=np.uint8)
+        flat_zbuffer = zbuffer.reshape(-1)
+        flat_indices = indices.reshape(-1)
+
+        for obj, position, (spin_a, spin_b, spin_c) in self.entries:
+            bounds = self.screen_bounds(obj, position)
+            if bounds is None:
+                self.offscreen += 1
+                continue
+            x0, x1, y0, y1 = bounds
+            near = self.K2 + position[2] - obj.bounding_radius()
+            if near > 0 and (zbuffer[y0:y1, x0:x1] > 1 / near).all():
+                # Everything under the bounding sphere is already nearer
+                self.hidden += 1
+                continue
+
+            cells, ooz, L = obj.project((A * spin_a) % MAX_RAD, (B * spin_b) % MAX_RAD,
+                                        (C * spin_c) % MAX_RAD, position)
+            # Objects drawn earlier win ties, like earlier samples do
+            closer = ooz > flat_zbuffer[cells]
+            cells = cells[closer]
+            flat_zbuffer[cells] = ooz[closer]
+            flat_indices[cells] = luminance_index(L[closer])
+            self.drawn += 1
+        return indices
+
+    def summary(self):
+        return "scene: {} objects, {} drawn, {} culled off screen, {} culled as hidden".format(
+            len(self.entries), self.drawn, self.offscreen, self.hidden)
+
+
+class FrameWriter:
+    """ フレームを事前確保したバッファにまとめ、1回の write で端末に渡すクラス """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.frames = 0
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._view = memoryview(self._buffer)
+
+    def fill(self, prefix, frame):
+        """ prefix と frame をバッファに並べ、そのバイト数を返す """
+        size = len(prefix) + len(frame)
+        if size > len(self._buffer):
+            # Only grows when the frame gets larger (e.g. a bigger terminal)
+            self._view.release()
+            self._buffer = bytearray(size)
+            self._view = memoryview(self._buffer)
+
+        view = self._view
+        view[:len(prefix)] = prefix
+        view[len(prefix):size] = frame
+        return size
+
+    def write_frame(self, prefix, frame):
+        """ prefix (画面消去のシーケンス) と frame を続けて書き込み、書き込んだバイト数を返す """
+        size = self.fill(prefix, frame)
+        view = self._view
+
+        # os.write may accept only part of the buffer; keep going until done
+        written = 0
+        while written < size:
+            try:
+                written += os.write(self.fd, view[written:size])
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+
+        self.count(size)
+        return size
+
+    async def write_frame_async(self, prefix, frame):
+        """
+        write_frame の asyncio 版 (fd はノンブロッキングにしておく)
+        端末が受け取れない間はイベントループに戻り、キー入力や次のフレームの計算を進めさせる
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        size = self.fill(prefix, frame)
+        view = self._view
+
+        written = 0
+        while written < size:
+            try:
+                written += os.write(self.fd, view[written:size])
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer(self.fd, _set_ready, writable)
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer(self.fd)
+
+        self.count(size)
+        return size
+
+    def count(self, size):
+        self.frames += 1
+        self.bytes_written += size
+
+    def summary(self):
+        average = self.bytes_written / self.frames if self.frames else 0
+        return "output: {} frames, {} bytes, {:.0f} bytes/frame".format(
+            self.frames, self.bytes_written, average)
+
+
+def _set_ready(future):
+    # The fd may be reported writable again before the waiter runs
+    if not future.done():
+        future.set_result(None)
+
+
+class FrameScheduler:
+    """
+    目標 FPS に合わせてフレームを進めるクラス
+    フレーム番号は経過時間から決まるので、計算が間に合わないときはフレームを飛ばす
+    """
+
+    def __init__(self, fps, frame_limit=0, duration=0, clock=time.monotonic, sleep=time.sleep):
+        self.fps = fps
+        # Stop after this many frames or seconds (0 = no limit)
+        self.frame_limit = frame_limit
+        self.duration = duration
+        self.clock = clock
+        self.sleep = sleep
+        self.skipped = 0
+        self.shown = 0
+        self.start = None
+        self.end = None
+
+    def frames(self):
+        """ 表示すべきフレーム番号を順に返す (上限に達したら終わる) """
+        self.start = self.clock()
+        index = 0
+        while not self.finished():
+            self.shown += 1
+            yield index
+            index, delay = self.advance(index)
+            if delay > 0:
+                self.sleep(delay)
+
+    async def frames_async(self):
+        """ frames の asyncio 版 (待つ間はイベントループに戻る) """
+        import asyncio
+        self.start = self.clock()
+        index = 0
+        while not self.finished():
+            self.shown += 1
+            yield index
+            index, delay = self.advance(index)
+            # Even with no delay, let the key and output callbacks run
+            await asyncio.sleep(max(delay, 0))
+
+    def finished(self):
+        if self.frame_limit and self.shown >= self.frame_limit:
+            return True
+        return bool(self.duration) and self.clock() - self.start >= self.duration
+
+    def advance(self, index):
+        """ index を表示し終えたときに呼び、(次のフレーム番号, それまで待つ秒数) を返す """
+        self.end = self.clock()
+        if self.fps <= 0:
+            return index + 1, 0
+
+        now = self.clock()
+        due = int((now - self.start) * self.fps)
+        if due > index:
+            # Fell behind: jump to the frame that is due now
+            self.skipped += due - index - 1
+            return due, 0
+        index += 1
+        return index, self.start + index / self.fps - now
+
+    def summary(self):
+        elapsed = (self.end - self.start) if self.end is not None else 0
+        rate = self.shown / elapsed if elapsed else 0
+        return "scheduler: {} fps target, {} frames in {:.2f} s ({:.1f} fps), {} frames skipped".format(
+            self.fps, self.shown, elapsed, rate, self.skipped)
+
+
+# Object rasterized by this worker process (set by _init_worker)
+_worker_obj = None
+
+
+def _init_worker(obj):
+    global _worker_obj
+    _worker_obj = obj
+    # Ctrl-C is handled by the main process, which shuts the pool down.
+    # SIGTERM must kill the worker, not run the terminal session's handler.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _compute_frame_in_worker(A, B, C):
+    return _worker_obj.backend.frame(_worker_obj, A, B, C)
+
+
+def start_worker_pool(obj, workers):
+    """ obj を計算するワーカープロセスを起動する """
+    import multiprocessing
+    # Never fork while another thread is halfway through importing NumPy
+    wait_for_numpy()
+    # All workers are started here with SIGINT ignored, so a Ctrl-C can
+    # never hit a freshly forked child before _init_worker has run
+    handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        return multiprocessing.Pool(workers, initializer=_init_worker, initargs=(obj,))
+    finally:
+        signal.signal(signal.SIGINT, handler)
+
+
+def _split_worker(obj, part, parts, cells, depth, indices, connection):
+    """ SplitBackend のプロセス: 受け取った角度ごとに担当の標本点を投影し、当たったセルだけを共有メモリに書き込む """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    count = obj.get_surface().shape[1] // 2
+    obj.keep_samples(count * part // parts, count * (part + 1) // parts)
+    size = obj.screen_width * obj.screen_height
+    cells = np.frombuffer(cells, dtype=np.int64, count=size, offset=part * size * 8)
+    depth = np.frombuffer(depth, dtype=np.float64, count=size, offset=part * size * 8)
+    indices = np.frombuffer(indices, dtype=np.uint8, count=size, offset=part * size)
+    while True:
+        angles = connection.recv()
+        if angles is None:
+            break
+        obj.culled.clear()
+        touched, ooz, L = obj.project(*angles)
+        count = len(touched)
+        cells[:count] = touched
+        depth[:count] = ooz
+        indices[:count] = luminance_index(L)
+        # Only the number of cells and the cull counts go back
+        connection.send((count, obj.culled))
+
+
+class SplitBackend(Backend):
+    """
+    標本点を parts 個に分けて別々のプロセスで投影し、一番手前の点を選んで1枚にするバックエンド
+    各プロセスは自分の点が当たったセルとその ooz・輝度インデックスだけを共有メモリに書き、
+    メインプロセスはそのセルだけで z-buffer の比較をする
+    --backend auto の候補には入れない (1コアの環境では numpy より遅い)
+    """
+
+    name = "split"
+
+    def __init__(self, parts):
+        self.parts = parts
+        # (screen size, K1, sampling) the processes were started for
+        self.layout = None
+        self.workers = []
+
+    def supports(self, obj):
+        # A scene has a z-buffer of its own; it is left to NumPy
+        return type(obj).rasterize is ThreeDimensionalObject.rasterize
+
+    def worker_backend(self):
+        return BACKENDS["numpy"]
+
+    def start(self, obj):
+        import multiprocessing
+        # Never fork while another thread is halfway through importing NumPy
+        wait_for_numpy()
+        # Room for every cell of the screen per part; a part fills the front
+        size = obj.screen_width * obj.screen_height
+        cells = multiprocessing.RawArray("q", self.parts * size)
+        depth = multiprocessing.RawArray("d", self.parts * size)
+        indices = multiprocessing.RawArray("B", self.parts * size)
+        self.cells = np.frombuffer(cells, dtype=np.int64).reshape(self.parts, size)
+        self.depth = np.frombuffer(depth, dtype=np.float64).reshape(self.parts, size)
+        self.indices = np.frombuffer(indices, dtype=np.uint8).reshape(self.parts, size)
+        # Built once here instead of in every process
+        obj.get_surface()
+        handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            for part in range(self.parts):
+                connection, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_split_worker, daemon=True,
+                                                  args=(obj, part, self.parts, cells, depth, indices, child))
+                process.start()
+                child.close()
+                self.workers.append((process, connection))
+        finally:
+            signal.signal(signal.SIGINT, handler)
+
+    def rasterize(self, obj, A, B, C=0):
+        layout = (obj.screen_width, obj.screen_height, obj.K1, obj.cache_params())
+        if layout != self.layout:
+            # The processes hold the samples for another size
+            self.close()
+            self.start(obj)
+            self.layout = layout
+        for _, connection in self.workers:
+            connection.send((A, B, C))
+        counts = []
+        for _, connection in self.workers:
+            count, culled = connection.recv()
+            counts.append(count)
+            obj.culled.update(culled)
+        # Depth test over the touched cells only, part by part. A part has
+        # at most one entry per cell, and a later part must be strictly
+        # nearer: the parts are consecutive runs of samples, so on a tie the
+        # earliest sample wins as it does in project().
+        zbuffer = np.zeros(obj.screen_width * obj.screen_height)
+        indices = np.zeros((obj.screen_height, obj.screen_width), dtype=np.uint8)
+        for part, count in enumerate(counts):
+            cells = self.cells[part, :count]
+            ooz = self.depth[part, :count]
+            nearer = np.flatnonzero(ooz > zbuffer[cells])
+            cells = cells[nearer]
+            zbuffer[cells] = ooz[nearer]
+            indices.reshape(-1)[cells] = self.indices[part, :count][nearer]
+        return indices
+
+    def close(self):
+        for process, connection in self.workers:
+            process.terminate()
+            process.join()
+            connection.close()
+        self.workers = []
+        self.layout = None
+
+
+class FramePipeline:
+    """
+    ワーカープロセスでこれから表示するフレームを先に計算しておくクラス
+    メインループは順番に frame() を呼んで結果を受け取るだけでよい
+    """
+
+    def __init__(self, obj, angles, workers, lookahead):
+        self.obj = obj
+        self.angles = angles
+        self.lookahead = lookahead
+        self.pool = start_worker_pool(obj, workers)
+        # frame index -> (cache key, async result), in frame order
+        self.pending = collections.OrderedDict()
+
+    def frame(self, index):
+        """ index 番目のフレームを返し、その先 lookahead フレーム分の計算を依頼する """
+        # Frames the scheduler skipped are no longer needed
+        while self.pending and next(iter(self.pending)) < index:
+            _, (key, result) = self.pending.popitem(last=False)
+            if result.ready():
+                self.obj.store_frame(key, result.get())
+
+        self.submit(index, index + self.lookahead + 1)
+
+        entry = self.pending.pop(index, None)
+        if entry is None:
+            # Cached when it was scheduled, or queued under a skipped frame
+            # with the same key and computed here
+            return self.obj.compute_frame(*self.angles(index))
+        key, result = entry
+        # Counted like a compute_frame miss so the cache summary stays honest
+        self.obj.frame_cache.misses += 1
+        started = self.obj.stats.clock()
+        output = result.get()
+        self.obj.stats.record("wait", started)
+        self.obj.store_frame(key, output)
         return output
 
+    def submit(self, first, last):
+        queued = {key for key, _ in self.pending.values()}
+        for index in range(first, last):
+            if index in self.pending:
+                continue
+            angles = self.angles(index)
+            key = self.obj.frame_key(*angles)
+            if key in queued or self.obj.has_frame(key):
+                continue
+            queued.add(key)
+            self.pending[index] = (key, self.pool.apply_async(_compute_frame_in_worker, angles))
+
+    def close(self):
+        # Frames still being computed are not needed any more
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+class CycleReplay:
+    """
+    1周期分のフレームを周期内の位置ごとに持つクラス
+    すべての位置がそろったら、それ以降のフレームは計算せずにここから出す
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.frames = [None] * period
+        self.missing = period
+
+    def get(self, index):
+        return self.frames[index % self.period]
+
+    def put(self, index, frame):
+        slot = index % self.period
+        if self.frames[slot] is None:
+            self.missing -= 1
+        self.frames[slot] = frame
+
+    def complete(self):
+        return self.missing == 0
+
+    def summary(self):
+        return "replay: {} of {} frames of the cycle recorded{}".format(
+            self.period - self.missing, self.period,
+            ", replaying without computing" if self.complete() else "")
+
+
+class AnimationFile:
+    """
+    1周期分のエンコード済みフレームを保存したファイル
+    ヘッダの後に同じ長さのフレームが並ぶので、i 番目のフレームの位置は計算で決まる
+    """
+
+    MAGIC = b"ASCIIANM"
+    VERSION = 1
+    # magic, version, width, height, reserved, frame count, frame size
+    HEADER = struct.Struct("<8sHHHHII")
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < self.HEADER.size:
+                raise ValueError("{} is not an animation file".format(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.width, self.height, _, self.frame_count, self.frame_size = \
+            self.HEADER.unpack_from(self.mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.mm.close()
+            raise ValueError("{} is not an animation file of version {}".format(path, self.VERSION))
+        if not self.frame_count or len(self.mm) < self.HEADER.size + self.frame_count * self.frame_size:
+            self.mm.close()
+            raise ValueError("{} is truncated".format(path))
+        # Frames are handed out as slices of this view, without copying
+        self.view = memoryview(self.mm)
+
+    @classmethod
+    def write(cls, path, width, height, frames):
+        frame_size = len(frames[0])
+        # Write to a temporary file first so a half-written file is never played
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, width, height, 0,
+                                    len(frames), frame_size))
+            f.writelines(frames)
+        os.replace(temporary, path)
+
+    def __len__(self):
+        return self.frame_count
+
+    def frame(self, index):
+        """ i 番目のフレームを指す memoryview (閉じる前に release する) """
+        offset = self.HEADER.size + index * self.frame_size
+        return self.view[offset:offset + self.frame_size]
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+class ScreenTooSmall(Exception):
+    """ 再生中に端末が bake したフレームより小さくなった """
+
+
+class Controls:
+    """
+    --interactive のキー操作で変わる再生の状態
+    space/p: 一時停止, +/-: 速く/遅く, a/b/c: X/Z/Y 軸の回転の入り切り, q: 終了
+    """
+
+    # The speed is 2 ** (level / 2) times the class spacings
+    MIN_LEVEL = -6
+    MAX_LEVEL = 6
+
+    def __init__(self, spacings):
+        # An axis that is switched on later turns as fast as the fastest one
+        fallback = max(spacings)
+        self.spacings = [spacing if spacing > 0 else fallback for spacing in spacings]
+        self.enabled = [spacing > 0 for spacing in spacings]
+        self.level = 0
+        self.paused = False
+        self.quit = False
+        # Where each axis is on its lattice of steps per turn
+        self.positions = [0, 0, 0]
+
+    def steps(self, axis):
+        return ASCIIAnimation.axis_steps(self.spacings[axis] * 2 ** (self.level / 2))
+
+    def press(self, keys):
+        """ 押されたキーを反映する """
+        for key in keys:
+            if key in (" ", "p"):
+                self.paused = not self.paused
+            elif key in ("+", "="):
+                self.set_level(self.level + 1)
+            elif key in ("-", "_"):
+                self.set_level(self.level - 1)
+            elif key in ("a", "b", "c"):
+                axis = "abc".index(key)
+                self.enabled[axis] = not self.enabled[axis]
+            elif key == "q":
+                self.quit = True
+
+    def set_level(self, level):
+        level = min(max(level, self.MIN_LEVEL), self.MAX_LEVEL)
+        steps = [self.steps(axis) for axis in range(3)]
+        self.level = level
+        # Carry every axis over to the nearest step of its new lattice
+        for axis in range(3):
+            self.positions[axis] = round(self.positions[axis] * self.steps(axis) / steps[axis]) % self.steps(axis)
+
+    def advance(self, frames):
+        """ frames フレーム分だけ回転を進める """
+        if self.paused:
+            return
+        for axis in range(3):
+            if self.enabled[axis]:
+                self.positions[axis] = (self.positions[axis] + frames) % self.steps(axis)
+
+    def angles(self):
+        """ 今の (A, B, C) (速さが既定なら ASCIIAnimation.angles と同じ値になる) """
+        return tuple(MAX_RAD * self.positions[axis] / self.steps(axis) for axis in range(3))
+
 
 class ASCIIAnimation:
     """ アニメーションを表示するクラス """
     A_spacing = 0
     B_spacing = 0
+    C_spacing = 0
+    fps = DEFAULT_FPS
+    # Number of worker processes computing frames ahead (0 = compute inline)
+    workers = 0
+    lookahead = 0
     clear_type = None
     obj = None
+    writer = None
+    scheduler = None
+    replay = None
+    stats = NULL_STATS
+    # Stop after this many frames or seconds (0 = run until interrupted)
+    frame_limit = 0
+    duration = 0
+    session = None
+    # Refit the object when the terminal is resized (off with --size or --output)
+    follow_terminal = False
+    # --size, or None for the size of the terminal
+    screen_size = None
+    # Arguments of fit_to_screen() used again after a resize
+    k1 = None
+    lod = 1.0
+    # Keys read by render_interactive() (Controls)
+    controls = None
+
+    def angles(self, index):
+        """ index 番目のフレームの (A, B, C) """
+        # Each axis takes a whole number of steps per turn, so the angles are
+        # exactly the same every cycle_length() frames. They follow the frame
+        # number, so the rotation speed is about A_spacing * fps rad/s
+        # whatever the frame took to compute.
+        angles = []
+        for spacing in (self.A_spacing, self.B_spacing, self.C_spacing):
+            steps = self.axis_steps(spacing)
+            angles.append(MAX_RAD * (index % steps) / steps)
+        return tuple(angles)
 
     def render_forever(self):
-        A = 0
-        B = 0
+        self.scheduler = FrameScheduler(self.fps, self.frame_limit, self.duration)
+        self.replay = self.create_replay()
+        if not self.geometry_reused():
+            # Every A comes with one B only; rotated points would never be reused
+            for cache in self.obj.geometry_caches():
+                cache.max_bytes = 0
+        lookahead = self.lookahead or 4 * self.workers
+        pipeline = None
+        try:
+            for index in self.scheduler.frames():
+                if self.follow_resize():
+                    self.replay = self.create_replay()
+                    if pipeline is not None:
+                        # The workers still rasterize for the old size
+                        pipeline.close()
+                        pipeline = None
 
-        while True:
-            if A > MAX_RAD:
-                A = 0
-            if B > MAX_RAD:
-                B = 0
+                output = self.replay.get(index) if self.replay is not None else None
+                if output is None:
+                    if self.workers <= 0:
+                        output = self.obj.compute_frame(*self.angles(index))
+                    else:
+                        if pipeline is None:
+                            pipeline = FramePipeline(self.obj, self.angles, self.workers, lookahead)
+                        output = pipeline.frame(index)
+                    if self.replay is not None and numpy_ready():
+                        self.replay.put(index, output)
+                        if self.replay.complete() and pipeline is not None:
+                            # Every frame of the cycle is in memory; nothing left to compute
+                            pipeline.close()
+                            pipeline = None
+                self.render_frame(output)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
 
-            output = self.obj.compute_frame(A, B)
-            self.render_frame(output)
+    def render_interactive(self):
+        """ キー操作を受け付けながら描画する (q か Ctrl-C で終わる) """
+        import asyncio
+        asyncio.run(self.render_async())
 
-            A += self.A_spacing
-            B += self.B_spacing
+    async def render_async(self):
+        """
+        次のフレームの計算を別スレッドで行い、その間にイベントループで今のフレームの書き込みと
+        キー入力を進める。端末が詰まっていても、前のフレームの書き込みを待つ間にキーが押されたら
+        計算したフレームを捨てて新しい状態から描き直し、q なら書きかけのフレームも捨てて終わる
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.controls = controls = Controls((self.A_spacing, self.B_spacing, self.C_spacing))
+        self.scheduler = FrameScheduler(self.fps, self.frame_limit, self.duration)
+        fd = self.writer.fd
+        blocking = os.get_blocking(fd)
+        # Set whenever a key changes the controls
+        changed = asyncio.Event()
+        flush = None
+        shown = None
+        previous = 0
+        with KeyboardInput(sys.stdin.fileno()) as keyboard:
+            def on_keys():
+                keys = keyboard.read()
+                if keys is None:
+                    # The terminal hung up; keep drawing without keys
+                    loop.remove_reader(keyboard.fd)
+                else:
+                    controls.press(keys)
+                    changed.set()
+
+            loop.add_reader(keyboard.fd, on_keys)
+            os.set_blocking(fd, False)
+            try:
+                async for index in self.scheduler.frames_async():
+                    # The rotation follows the frame number, as in render_forever
+                    controls.advance(index - previous)
+                    previous = index
+                    if controls.quit:
+                        break
+                    changed.clear()
+                    angles = controls.angles()
+                    if self.follow_resize():
+                        shown = None
+                    if angles == shown:
+                        # Paused or every axis off: the screen is up to date
+                        continue
+                    output = await loop.run_in_executor(None, self.obj.compute_frame, *angles)
+                    if flush is not None and not await self.wait_for_flush(flush, changed):
+                        # A key came while the previous frame was still going
+                        # out; this one may be stale, so start from the new state
+                        continue
+                    flush = loop.create_task(self.render_frame_async(output))
+                    shown = angles
+                # The last frame is still going out; q drops it
+                while flush is not None and not controls.quit:
+                    changed.clear()
+                    if await self.wait_for_flush(flush, changed):
+                        break
+            finally:
+                if flush is not None and not flush.done():
+                    flush.cancel()
+                    try:
+                        await flush
+                    except asyncio.CancelledError:
+                        pass
+                    if os.isatty(fd):
+                        # Drop what the terminal has not taken yet, so
+                        # restoring it does not wait behind a stalled reader
+                        import termios
+                        termios.tcflush(fd, termios.TCOFLUSH)
+                loop.remove_reader(keyboard.fd)
+                # Blocking again, so the terminal is restored in one piece
+                os.set_blocking(fd, blocking)
+
+    @staticmethod
+    async def wait_for_flush(flush, changed):
+        """ flush が終わるか changed が立つまで待ち、flush が終わったかを返す (書き込みの例外はここで伝える) """
+        import asyncio
+        waiter = asyncio.ensure_future(changed.wait())
+        try:
+            await asyncio.wait((flush, waiter), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        if not flush.done():
+            return False
+        flush.result()
+        return True
+
+    async def render_frame_async(self, output):
+        stats = self.stats
+        started = stats.clock()
+        output = stats.overlay(output, self.obj.frame_cache, self.obj.disk_cache)
+        prefix, body = self.clear_type.prepare(output)
+        started = stats.record("clear", started)
+        await self.writer.write_frame_async(prefix, body)
+        stats.record("write", started)
+        stats.end_frame()
+        preload_numpy()
+
+    def create_replay(self):
+        """ 1周期分のフレームがフレームキャッシュの上限に収まるなら CycleReplay を返す """
+        period = self.cycle_length()
+        if period * self.obj.frame_bytes() > self.obj.frame_cache.max_bytes:
+            return None
+        return CycleReplay(period)
+
+    def geometry_reused(self):
+        """ 周期の中で同じ A と C が別の B と組み合わさるか (点群のキャッシュが役に立つか) """
+        return self.cycle_length() > math.lcm(self.axis_steps(self.A_spacing),
+                                              self.axis_steps(self.C_spacing))
+
+    def cycle_summary(self):
+        period = self.cycle_length()
+        size = period * self.obj.frame_bytes()
+        if size > self.obj.frame_cache.max_bytes:
+            note = "more than the frame cache holds, so frames keep being computed"
+        else:
+            note = "replayed from memory once the first cycle is done"
+        return "cycle: {} frames ({} x {} x {} steps), {} bytes of frames, {}".format(
+            period, self.axis_steps(self.A_spacing), self.axis_steps(self.B_spacing),
+            self.axis_steps(self.C_spacing), size, note)
+
+    def follow_resize(self):
+        """ 端末の大きさが変わっていたらオブジェクトを合わせ直し、変わったかどうかを返す """
+        if not self.follow_terminal or not self.session.poll_resize():
+            return False
+        width, height = self.session.size()
+        obj = self.obj
+        if (width, height) == (obj.screen_width, obj.screen_height):
+            return False
+        obj.fit_to_screen(width, height, self.k1, self.lod)
+        self.clear_type.reset()
+        return True
+
+    def cycle_length(self):
+        """ すべての軸が同時に1回転して最初のフレームに戻るまでのフレーム数 """
+        return math.lcm(self.axis_steps(self.A_spacing), self.axis_steps(self.B_spacing),
+                        self.axis_steps(self.C_spacing))
+
+    @staticmethod
+    def axis_steps(spacing):
+        if spacing <= 0:
+            return 1
+        return max(1, round(MAX_RAD / spacing))
+
+    def bake(self, path, workers=None):
+        """ 1周期分のフレームを全コアで計算して path に保存する """
+        angles = [self.angles(index) for index in range(self.cycle_length())]
+        with start_worker_pool(self.obj, workers or os.cpu_count()) as pool:
+            frames = pool.starmap(_compute_frame_in_worker, angles)
+        AnimationFile.write(path, self.obj.screen_width, self.obj.screen_height, frames)
+        return len(frames)
+
+    def open_animation(self, path):
+        """ bake したファイルを開き、画面の大きさに合うか確かめる (合わなければ ValueError) """
+        animation = AnimationFile(path)
+        if self.follow_terminal:
+            width, height = self.session.size()
+            # A smaller frame is drawn in the top left corner of the terminal
+            fits = animation.width <= width and animation.height <= height
+        elif self.screen_size is not None:
+            width, height = self.screen_size
+            fits = (width, height) == (animation.width, animation.height)
+        else:
+            # Nothing to compare with when neither --size nor a terminal is given
+            return animation
+        if not fits:
+            animation.close()
+            raise ValueError("{} は {}x{} で bake されていて、{}x{} の画面では再生できません".format(
+                path, animation.width, animation.height, width, height))
+        return animation
+
+    def play(self, animation):
+        """ bake したフレームを再計算せずにそのまま端末に流す """
+        # escape, win and linux write the mapped frame as it is; delta and
+        # the status line need bytes
+        copy = isinstance(self.clear_type, DeltaCharacter) or self.stats.show_status
+        size = self.session.size() if self.follow_terminal else None
+        self.scheduler = FrameScheduler(self.fps, self.frame_limit, self.duration)
+        for index in self.scheduler.frames():
+            if self.follow_terminal and self.session.poll_resize() and self.session.size() != size:
+                size = width, height = self.session.size()
+                if animation.width > width or animation.height > height:
+                    raise ScreenTooSmall("端末が {}x{} になり、{}x{} のフレームが収まりません".format(
+                        width, height, animation.width, animation.height))
+                # Wipe what is left outside the frame at the old size
+                self.clear_type.reset()
+            with animation.frame(index % len(animation)) as frame:
+                self.render_frame(bytes(frame) if copy else frame)
 
     def render_frame(self, output):
-        self.clear_type.clear()
-        for y in range(SCREEN_HEIGHT):
-            for x in range(SCREEN_WIDTH):
-                sys.stdout.write(output[x][y])
-            sys.stdout.write(os.linesep)
-        sys.stdout.flush()
+        stats = self.stats
+        started = stats.clock()
+        output = stats.overlay(output, self.obj.frame_cache, self.obj.disk_cache)
+        prefix, body = self.clear_type.prepare(output)
+        started = stats.record("clear", started)
+        self.writer.write_frame(prefix, body)
+        stats.record("write", started)
+        stats.end_frame()
+        # The first frame is out; NumPy can load while the next ones are drawn
+        preload_numpy()
 
 
 class Main(ASCIIAnimation):
     """
-    以下の二つの要素はそれぞれX軸、Z軸の回転速度を表します。
+    以下の三つの要素はそれぞれX軸、Z軸、Y軸の回転速度を表します。
     0以上6.28以下で任意の値を設定できます。
     0を設定するとその軸の回転が止まります。
     """
     A_spacing = 0.04
     B_spacing = 0.04
+    C_spacing = 0
+
+    bake_path = None
+    play_path = None
+    trace_path = None
+    # Take keys with render_interactive() (--interactive)
+    interactive = False
+    # File the frames go to instead of the terminal (--output)
+    output = None
+    # Which backend draws the frames and how it was chosen
+    backend_summary = None
 
     def start(self):
+        # Draw the first frames before paying for the NumPy import
+        defer_numpy()
         self.process_arguments()
-        self.render_forever()
+        if self.bake_path is not None:
+            count = self.bake(self.bake_path, self.workers)
+            print("{}: {} frames ({}x{})".format(self.bake_path, count, self.obj.screen_width,
+                                                 self.obj.screen_height))
+            return
 
-    def process_arguments(self):
-        args = sys.argv
-        objtype = ""
-        cleartype = ""
-        if len(args) == 3:
-            objtype = args[1]
-            cleartype = args[2]
+        animation = None
+        if self.play_path is not None:
+            try:
+                animation = self.open_animation(self.play_path)
+            except (OSError, ValueError) as e:
+                sys.exit("再生できません: {}".format(e))
         else:
-            objtype = "donut"
-            cleartype = "win"
+            print(self.backend_summary, file=sys.stderr)
+            print(self.cycle_summary(), file=sys.stderr)
+        error = None
+        try:
+            with self.session:
+                if animation is not None:
+                    self.play(animation)
+                elif self.interactive:
+                    self.render_interactive()
+                else:
+                    self.render_forever()
+        except (KeyboardInterrupt, BrokenPipeError):
+            # Ctrl-C, or the reader of --output - went away
+            pass
+        except ScreenTooSmall as e:
+            # Reported once the terminal is back to normal
+            error = e
+        finally:
+            self.obj.backend.close()
+            if self.obj.disk_cache is not None:
+                self.obj.disk_cache.flush()
+            if animation is not None:
+                animation.close()
+            if self.trace_path is not None:
+                self.stats.write_trace(self.trace_path)
+        self.print_summary()
+        if error is not None:
+            sys.exit("再生を止めました: {}".format(error))
 
-        obj = self.create_object(objtype)
-        clear_type = self.create_clear_type(cleartype)
+    def print_summary(self):
+        print(self.obj.frame_cache.summary(), file=sys.stderr)
+        print(self.obj.geometry_cache.summary(), file=sys.stderr)
+        if self.obj.disk_cache is not None:
+            print(self.obj.disk_cache.summary(), file=sys.stderr)
+        print(self.writer.summary(), file=sys.stderr)
+        if isinstance(self.clear_type, DeltaCharacter):
+            print(self.clear_type.summary(), file=sys.stderr)
+        # Ctrl-C before the first frame leaves no scheduler behind
+        if self.scheduler is not None:
+            print(self.scheduler.summary(), file=sys.stderr)
+        if self.replay is not None:
+            print(self.replay.summary(), file=sys.stderr)
+        if isinstance(self.obj, Scene):
+            print(self.obj.summary(), file=sys.stderr)
+        print(self.obj.cull_summary(), file=sys.stderr)
+        if self.stats.enabled:
+            print(self.stats.summary(self.obj.frame_cache, self.obj.disk_cache), file=sys.stderr)
 
-        if obj is None or clear_type is None:
-            self.show_error_message()
-            sys.exit(0)
+    def process_arguments(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("objtype", nargs="?", default="donut",
+                            help="オブジェクトのタイプ ({}, カンマ区切りで複数並べる 例: donut,cube)".format(
+                                " or ".join(OBJECT_TYPES)))
+        parser.add_argument("cleartype", nargs="?", default="win", choices=CLEAR_TYPES,
+                            help="文字を削除する方法")
+        parser.add_argument("--cache-bytes", type=parse_bytes, default=DEFAULT_CACHE_BYTES,
+                            help="フレームキャッシュのメモリ上限 (例: 64M)")
+        parser.add_argument("--geometry-cache-bytes", type=parse_bytes, default=DEFAULT_GEOMETRY_BYTES,
+                            help="回転させた点群のキャッシュのメモリ上限 (例: 128M)")
+        parser.add_argument("--disk-cache", metavar="DIR", default=default_cache_dir(),
+                            help="フレームを保存するディレクトリ")
+        parser.add_argument("--disk-cache-bytes", type=parse_bytes, default=DEFAULT_DISK_CACHE_BYTES,
+                            help="ディスクキャッシュの容量上限 (例: 256M)")
+        parser.add_argument("--no-disk-cache", action="store_true",
+                            help="ディスクキャッシュを使わない")
+        parser.add_argument("--light", type=parse_vector, default=LIGHT,
+                            help="光の方向 x,y,z (例: 0,1,-1)")
+        parser.add_argument("--k1", type=parse_positive_float, default=None,
+                            help="投影の倍率 (省略すると画面の大きさに合わせる)")
+        parser.add_argument("--lod", type=parse_finite_float, default=1.0,
+                            help="標本化の細かさの倍率 ({} まで, 0 でオブジェクトの既定の間隔)".format(MAX_LOD))
+        parser.add_argument("--fps", type=parse_non_negative_float, default=None,
+                            help="目標フレームレート (0 で無制限, 既定は {} で --output のときは 0)".format(DEFAULT_FPS))
+        parser.add_argument("--workers", type=int, default=0,
+                            help="先のフレームを計算するワーカープロセス数 (0 で使わない)")
+        parser.add_argument("--lookahead", type=int, default=0,
+                            help="先に計算しておくフレーム数 (0 でワーカー数の4倍)")
+        parser.add_argument("--bake", metavar="FILE",
+                            help="1周期分のフレームを計算して FILE に保存する")
+        parser.add_argument("--play", metavar="FILE",
+                            help="--bake で保存した FILE を再生する")
+        parser.add_argument("--stats", action="store_true",
+                            help="段階ごとの所要時間とキャッシュのヒット率を最下行に表示する")
+        parser.add_argument("--trace", metavar="FILE",
+                            help="段階ごとの所要時間を Chrome の trace event 形式で FILE に保存する")
+        parser.add_argument("--size", type=parse_size, default=None,
+                            help="画面の大きさ 幅x高さ (例: 80x24, 省略すると端末の大きさ)")
+        parser.add_argument("--frames", type=int, default=0,
+                            help="このフレーム数を表示したら終了する (0 で無制限)")
+        parser.add_argument("--duration", type=float, default=0,
+                            help="この秒数が経ったら終了する (0 で無制限)")
+        parser.add_argument("--output", metavar="FILE",
+                            help="端末の代わりに FILE に書き出す (- で標準出力, /dev/null で捨てる)")
+        parser.add_argument("--backend", choices=["auto"] + list(BACKENDS), default="numpy",
+                            help="フレームを計算する方法 (auto で起動時に一番速いものを測って選ぶ)")
+        parser.add_argument("--split", type=int, default=0,
+                            help="1フレームの標本点を分けて計算するプロセス数 (0 で分けない)")
+        parser.add_argument("--interactive", action="store_true",
+                            help="キーで操作する (space: 一時停止, +/-: 速さ, a/b/c: 軸の回転, q: 終了)")
+        args = parser.parse_args()
+        # Checked before anything is opened; parser.error exits with status 2
+        unknown = [name for name in args.objtype.split(",") if name not in OBJECT_TYPES]
+        if unknown:
+            parser.error("オブジェクトのタイプが無効です: {} ({})".format(
+                ", ".join(unknown), " or ".join(OBJECT_TYPES)))
+        if args.lod > MAX_LOD:
+            parser.error("--lod は {} 以下にしてください".format(MAX_LOD))
+
+        sys.stdout.flush()
+        if args.output is None or args.output == "-":
+            fd = sys.stdout.fileno()
+        else:
+            # Kept on self so the file stays open while frames are written
+            self.output = open(args.output, "wb")
+            fd = self.output.fileno()
+        session = TerminalSession(fd)
+        disk_cache = None
+        if not args.no_disk_cache:
+            try:
+                disk_cache = DiskFrameCache(args.disk_cache, args.disk_cache_bytes)
+            except OSError as e:
+                print("ディスクキャッシュを使用できません: {}".format(e), file=sys.stderr)
+        obj = self.create_object(args.objtype, FrameCache(args.cache_bytes), disk_cache,
+                                 GeometryCache(args.geometry_cache_bytes))
+        clear_type = self.create_clear_type(args.cleartype, session)
 
+        obj.light = args.light
+        if args.play is None:
+            # --play never rasterizes, so the object is neither fitted nor given a backend
+            width, height = args.size or (SCREEN_WIDTH, SCREEN_HEIGHT)
+            obj.fit_to_screen(width, height, args.k1, args.lod)
+            if args.split > 1:
+                obj.backend, self.backend_summary = self.create_split_backend(args.split, obj)
+            else:
+                obj.backend, self.backend_summary = self.create_backend(args.backend, obj, args.disk_cache)
         self.obj = obj
         self.clear_type = clear_type
+        self.session = session
+        self.follow_terminal = args.size is None and args.output is None
+        self.screen_size = args.size
+        self.k1 = args.k1
+        self.lod = args.lod
+        self.writer = FrameWriter(session.fd)
+        if args.fps is not None:
+            self.fps = args.fps
+        elif args.output is not None:
+            # Nobody is watching; generate frames as fast as possible
+            self.fps = 0
+        self.frame_limit = args.frames
+        self.duration = args.duration
+        self.workers = args.workers
+        self.lookahead = args.lookahead
+        self.bake_path = args.bake
+        self.play_path = args.play
+        self.trace_path = args.trace
+        if args.interactive and not KeyboardInput.available(sys.stdin.fileno()):
+            print("キー入力を読めないため --interactive を使用できません。", file=sys.stderr)
+        else:
+            self.interactive = args.interactive
+        if args.stats or args.trace:
+            self.stats = FrameStats(args.stats, TRACE_EVENTS if args.trace else 0)
+            obj.stats = self.stats
 
-    def create_object(self, objtype):
+    def create_object(self, objtype, frame_cache=None, disk_cache=None, geometry_cache=None):
+        if "," in objtype:
+            # e.g. donut,cube: a scene with the objects side by side
+            objects = [self.create_object(name) for name in objtype.split(",")]
+            if None in objects:
+                return None
+            return Scene.row(objects, frame_cache, disk_cache, geometry_cache)
         if objtype == "donut":
-            return Donut()
+            return Donut(frame_cache, disk_cache, geometry_cache)
+        elif objtype == "cube":
+            return Cube(frame_cache, disk_cache, geometry_cache)
         return None
 
-    def create_clear_type(self, cleartype):
+    def create_backend(self, name, obj, cache_dir):
+        """ (バックエンド, 選んだ経緯の説明) を返す。auto なら前回の結果か計測で選ぶ """
+        if name != "auto":
+            backend = BACKENDS[name]
+            if backend.available() and backend.supports(obj):
+                return backend, "backend: {}".format(name)
+            print("バックエンド {} を使用できません。numpy を使います。".format(name), file=sys.stderr)
+            return BACKENDS["numpy"], "backend: numpy"
+
+        candidates = [backend for backend in BACKENDS.values()
+                      if backend.available() and backend.supports(obj)]
+        if len(candidates) == 1:
+            return candidates[0], "backend: {} (auto, the only one available)".format(candidates[0].name)
+        choices = BackendChoices(os.path.join(cache_dir, "backend.json"))
+        key = choices.key(obj, candidates)
+        name = choices.get(key)
+        if name in [backend.name for backend in candidates]:
+            return BACKENDS[name], "backend: {} (auto, timed on an earlier run)".format(name)
+
+        timings = calibrate_backends(obj, candidates)
+        name = min(timings, key=timings.get)
+        choices.put(key, name)
+        return BACKENDS[name], "backend: {} (auto, {} per frame)".format(name, ", ".join(
+            "{} {:.1f} ms".format(backend, seconds * 1000)
+            for backend, seconds in sorted(timings.items(), key=lambda item: item[1])))
+
+    def create_split_backend(self, parts, obj):
+        backend = SplitBackend(parts)
+        if not backend.supports(obj):
+            print("このオブジェクトは分けて計算できません。numpy を使います。", file=sys.stderr)
+            return BACKENDS["numpy"], "backend: numpy"
+        return backend, "backend: numpy, each frame split across {} processes".format(parts)
+
+    def create_clear_type(self, cleartype, session):
         if cleartype == "escape":
-            return EscapeCharacter.instance()
+            return EscapeCharacter(session)
         elif cleartype == "win":
-            return WinCommand.instance()
+            return WinCommand(session)
         elif cleartype == "linux":
-            return LinuxUnixCommand.instance()
+            return LinuxUnixCommand(session)
+        elif cleartype == "delta":
+            return DeltaCharacter(session)
         return None
 
-    def show_error_message(self):
-        print("コマンドライン引数が無効です。")
-        print("第一引数：オブジェクトのタイプ (donut)")
-        print("第二引数：文字を削除する方法 (escape or win or linux)")
+
+class TerminalSession:
+    """
+    端末の制御シーケンスを起動時に一度だけ調べて保持し、
+    終了時 (Ctrl-C を含む) に端末を元の状態に戻すクラス
+    """
+
+    # ANSI sequences used when terminfo is not available
+    DEFAULT_CAPABILITIES = {
+        "clear": b"\x1b[H\x1b[2J",
+        "home": b"\x1b[H",
+        "smcup": b"\x1b[?1049h",
+        "rmcup": b"\x1b[?1049l",
+        "civis": b"\x1b[?25l",
+        "cnorm": b"\x1b[?25h",
+    }
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.active = False
+        self.resized = False
+        self._previous_sigterm = None
+        self._previous_sigwinch = None
+
+        # Windows consoles only understand the sequences once VT processing
+        # is switched on; without it the cursor is moved through the console API.
+        self.virtual_terminal = (os.name != "nt" or not os.isatty(fd)
+                                 or self.enable_virtual_terminal())
+
+        capabilities = self.lookup_capabilities(fd)
+        self.clear_sequence = capabilities["clear"]
+        self.home_sequence = capabilities["home"]
+        self.enter_sequence = capabilities["smcup"] + capabilities["civis"]
+        self.exit_sequence = capabilities["cnorm"] + capabilities["rmcup"]
+
+    @classmethod
+    def lookup_capabilities(cls, fd):
+        capabilities = dict(cls.DEFAULT_CAPABILITIES)
+        try:
+            import curses
+            curses.setupterm(fd=fd)
+        except Exception:
+            return capabilities
+
+        for name in capabilities:
+            value = curses.tigetstr(name)
+            if value:
+                # Drop terminfo padding such as $<5>
+                capabilities[name] = re.sub(rb"\$<[\d.*/]+>", b"", value)
+        return capabilities
+
+    @staticmethod
+    def enable_virtual_terminal():
+        try:
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.GetStdHandle(-11)
+            mode = ctypes.c_uint32()
+            if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+                return False
+            # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+            return bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))
+        except Exception:
+            return False
+
+    @staticmethod
+    def move_console_cursor_home():
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # COORD(0, 0) packed into a DWORD
+        kernel32.SetConsoleCursorPosition(kernel32.GetStdHandle(-11), 0)
+
+    def enter(self):
+        # Files and pipes get the frames only, no alternate screen
+        if self.active or not os.isatty(self.fd):
+            return
+        self.active = True
+        atexit.register(self.restore)
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+            if hasattr(signal, "SIGWINCH"):
+                self._previous_sigwinch = signal.signal(signal.SIGWINCH, self._on_sigwinch)
+        if self.virtual_terminal:
+            self.write(self.enter_sequence + self.clear_sequence)
+
+    def restore(self):
+        if not self.active:
+            return
+        self.active = False
+        if self._previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self._previous_sigterm)
+            self._previous_sigterm = None
+        if self._previous_sigwinch is not None:
+            signal.signal(signal.SIGWINCH, self._previous_sigwinch)
+            self._previous_sigwinch = None
+        if self.virtual_terminal:
+            self.write(self.exit_sequence)
+
+    def write(self, data):
+        try:
+            os.write(self.fd, data)
+        except OSError:
+            pass
+
+    def clear_screen(self):
+        if self.virtual_terminal:
+            self.write(self.clear_sequence)
+
+    def size(self):
+        """ 端末の現在の大きさ (幅, 高さ) """
+        try:
+            return tuple(os.get_terminal_size(self.fd))
+        except OSError:
+            return tuple(shutil.get_terminal_size())
+
+    def poll_resize(self):
+        """ 前回の呼び出しから端末の大きさが変わったかもしれないなら True """
+        if self._previous_sigwinch is None:
+            # No SIGWINCH (e.g. Windows): the caller compares the size every frame
+            return True
+        resized = self.resized
+        self.resized = False
+        return resized
+
+    def _on_sigterm(self, signum, frame):
+        # Unwind through the with block so the terminal gets restored
+        raise SystemExit(128 + signum)
+
+    def _on_sigwinch(self, signum, frame):
+        # Only flag it; the render loop refits between frames
+        self.resized = True
+
+    def __enter__(self):
+        self.enter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.restore()
+
+
+class KeyboardInput:
+    """ 端末のキーを Enter を待たずに読むクラス (終了時に端末の設定を元に戻す) """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._attributes = None
+        self._blocking = True
+
+    @staticmethod
+    def available(fd):
+        return os.isatty(fd) and importlib.util.find_spec("termios") is not None
+
+    def enter(self):
+        import termios
+        import tty
+        self._attributes = termios.tcgetattr(self.fd)
+        # No echo and no line buffering; Ctrl-C still raises KeyboardInterrupt
+        tty.setcbreak(self.fd)
+        self._blocking = os.get_blocking(self.fd)
+        os.set_blocking(self.fd, False)
+
+    def restore(self):
+        if self._attributes is None:
+            return
+        import termios
+        os.set_blocking(self.fd, self._blocking)
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self._attributes)
+        self._attributes = None
+
+    def read(self):
+        """ 届いているキーをすべて返す (端末が閉じられたら None) """
+        try:
+            data = os.read(self.fd, 64)
+        except BlockingIOError:
+            return ""
+        except OSError:
+            return None
+        return data.decode(errors="replace") if data else None
+
+    def __enter__(self):
+        self.enter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.restore()
 
 
 class ClearType(object, metaclass=abc.ABCMeta):
     """ ターミナルに書かれた文字を削除する方法を表すクラス """
 
+    def __init__(self, session):
+        self.session = session
+
     @abc.abstractmethod
     def clear(self):
+        """ フレームの前に書き込むバイト列を返す """
         pass
 
+    def prepare(self, frame):
+        """ 端末に書き込む (prefix, body) を返す """
+        return self.clear(), frame
 
-# Singleton
-class EscapeCharacter(ClearType):
-    _instance = None
+    def reset(self):
+        """ 端末の大きさが変わったとき、古い大きさで描いた文字を消す """
+        self.session.clear_screen()
 
-    def __init__(self):
-        raise RuntimeError("This class is singleton. Please use instance() class method.")
 
-    @classmethod
-    def instance(cls):
-        if cls._instance is None:
-            cls._instance = cls.__new__(cls)
-        return cls._instance
+class EscapeCharacter(ClearType):
+    """ カーソルを左上に戻して上書きする """
 
     def clear(self):
-        sys.stdout.write("\x1b[H")
+        return self.session.home_sequence
 
 
-# Singleton
 class WinCommand(ClearType):
-    _instance = None
+    """ Windows のコンソール (cls の代わりにプロセス内で消去する) """
 
-    def __init__(self):
-        raise RuntimeError("This class is singleton. Please use instance() class method.")
+    def clear(self):
+        if self.session.virtual_terminal:
+            return self.session.clear_sequence
+        self.session.move_console_cursor_home()
+        return b""
 
-    @classmethod
-    def instance(cls):
-        if cls._instance is None:
-            cls._instance = cls.__new__(cls)
-        return cls._instance
+
+class LinuxUnixCommand(ClearType):
+    """ Linux/Unix の端末 (clear コマンドの代わりに terminfo の clear を使う) """
 
     def clear(self):
-        os.system("cls")
+        return self.session.clear_sequence
 
 
-# Singleton
-class LinuxUnixCommand(ClearType):
-    _instance = None
+class DeltaCharacter(ClearType):
+    """ 前のフレームから変化したセルだけをカーソル移動で書き換える """
 
-    def __init__(self):
-        raise RuntimeError("This class is singleton. Please use instance() class method.")
+    # Unchanged cells between two changes are rewritten instead of starting a
+    # new run when the gap is shorter than a cursor move sequence
+    MERGE_GAP = 8
 
-    @classmethod
-    def instance(cls):
-        if cls._instance is None:
-            cls._instance = cls.__new__(cls)
-        return cls._instance
+    def __init__(self, session):
+        super().__init__(session)
+        self.previous = None
+        self.full_frames = 0
+        self.delta_frames = 0
 
     def clear(self):
-        os.system("clear")
+        return self.session.home_sequence
+
+    def reset(self):
+        super().reset()
+        # The next frame has to be drawn in full
+        self.previous = None
+
+    def prepare(self, frame):
+        previous = self.previous
+        self.previous = frame
+        # The last line end is dropped so a full repaint never scrolls the
+        # terminal and the cursor addresses below stay valid.
+        full = frame[:-len(LINE_END)]
+        # Until NumPy has loaded, every frame is a full repaint
+        if previous is None or len(previous) != len(frame) or not numpy_ready():
+            self.full_frames += 1
+            return self.clear(), full
+        if previous is frame:
+            self.delta_frames += 1
+            return b"", b""
+
+        stride = frame.index(b"\n") + 1
+        width = stride - len(LINE_END)
+        current = np.frombuffer(frame, dtype=np.uint8).reshape(-1, stride)[:, :width]
+        before = np.frombuffer(previous, dtype=np.uint8).reshape(-1, stride)[:, :width]
+
+        changed = np.flatnonzero(current != before)
+        rows = changed // width
+        cols = changed % width
+
+        # Split the changed cells into runs on the same row
+        starts = np.ones(len(changed), dtype=bool)
+        starts[1:] = (rows[1:] != rows[:-1]) | (cols[1:] - cols[:-1] > self.MERGE_GAP + 1)
+        ends = np.empty(len(changed), dtype=bool)
+        ends[:-1] = starts[1:]
+        ends[-1:] = True
+
+        parts = []
+        size = 0
+        for row, first, last in zip(rows[starts].tolist(), cols[starts].tolist(),
+                                    cols[ends].tolist()):
+            part = b"\x1b[%d;%dH" % (row + 1, first + 1) + current[row, first:last + 1].tobytes()
+            size += len(part)
+            if size >= len(full):
+                self.full_frames += 1
+                return self.clear(), full
+            parts.append(part)
+
+        self.delta_frames += 1
+        return b"", b"".join(parts)
+
+    def summary(self):
+        frames = self.full_frames + self.delta_frames
+        share = self.delta_frames / frames if frames else 0
+        return "delta: {} full repaints, {} delta frames ({:.0%} of frames)".format(
+            self.full_frames, self.delta_frames, share)
 
 
 if __name__ == "__main__":
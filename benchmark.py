@@ -0,0 +1,319 @@
+"""
+描画の各段階の速度を測り、結果を JSON で出力するベンチマーク
+高速化した経路が参照実装 (Donut.rasterize_reference) と同じフレームを出すかも確認する
+参照実装は裏面を消さないので、裏を向いた標本点が勝ったセルだけは違ってよい
+
+python3 benchmark.py
+python3 benchmark.py --sizes 80x24,200x60 --lods 0.5,1 --output bench.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import Animation
+
+ANIMATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Animation.py")
+
+# Angles used by the differential check
+CHECK_ANGLES = [(0, 0), (0.4, 1.2), (1, 2), (2.5, 0.3), (3.3, 4.4), (5.9, 6.1)]
+
+# Share of drawn cells allowed to differ from the reference (depth ties)
+TOLERANCE = 0.005
+
+
+def make_donut(width, height, lod):
+    obj = Animation.Donut(Animation.FrameCache())
+    obj.fit_to_screen(width, height, lod=lod)
+    return obj
+
+
+def time_calls(function, arguments):
+    """ arguments を順に渡して呼び出し、1回あたりの秒数の一覧を返す """
+    times = []
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def measure_allocations(function, arguments):
+    """ 1回あたりのメモリ確保回数とピークのバイト数 """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        for args in arguments:
+            function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return {"blocks_per_call": blocks / len(arguments), "peak_bytes": peak}
+
+
+def summarize(times):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    return {
+        "calls": len(times),
+        "mean_ms": mean * 1000,
+        "p50_ms": times[len(times) // 2] * 1000,
+        "max_ms": times[-1] * 1000,
+        "frames_per_sec": 1 / mean if mean else None,
+    }
+
+
+def bench_stage(function, arguments):
+    result = summarize(time_calls(function, arguments))
+    result["allocations"] = measure_allocations(function, arguments[:5])
+    return result
+
+
+def bench_case(width, height, lod, frames):
+    angles = [(index * 0.04 % Animation.MAX_RAD, index * 0.02 % Animation.MAX_RAD)
+              for index in range(frames)]
+
+    obj = make_donut(width, height, lod)
+    # Build the point cloud outside the timed section
+    started = time.perf_counter()
+    obj.get_surface()
+    setup = time.perf_counter() - started
+
+    def compute_cold(A, B):
+        obj.frame_cache = Animation.FrameCache()
+        obj.compute_frame(A, B)
+
+    cold = bench_stage(compute_cold, angles)
+    for A, B in angles:
+        obj.compute_frame(A, B)
+    warm = bench_stage(obj.compute_frame, angles)
+
+    # Same A, so every frame after the first reuses the rotated points
+    geometry_hit = bench_stage(lambda B: obj.rasterize(angles[0][0], B),
+                               [(B,) for _, B in angles])
+
+    # Fastest frame of every available backend, timed as --backend auto does,
+    # and of one frame split across all cores
+    split = Animation.SplitBackend(max(2, os.cpu_count()))
+    try:
+        backends = {name: seconds * 1000 for name, seconds in
+                    Animation.calibrate_backends(obj, available_backends(obj) + [split]).items()}
+    finally:
+        split.close()
+
+    indices = [(obj.rasterize(A, B),) for A, B in angles]
+    encode = bench_stage(Animation.encode_frame, indices)
+
+    encoded = [(Animation.encode_frame(frame[0]),) for frame in indices]
+    with open(os.devnull, "wb") as devnull:
+        session = Animation.TerminalSession(devnull.fileno())
+        writer = Animation.FrameWriter(devnull.fileno())
+        escape = Animation.EscapeCharacter(session)
+        delta = Animation.DeltaCharacter(session)
+        output = bench_stage(lambda frame: writer.write_frame(*escape.prepare(frame)), encoded)
+        writer.bytes_written = 0
+        writer.frames = 0
+        delta_output = bench_stage(lambda frame: writer.write_frame(*delta.prepare(frame)), encoded)
+        delta_output["bytes_per_frame"] = writer.bytes_written / max(writer.frames, 1)
+
+    return {
+        "width": width,
+        "height": height,
+        "lod": lod,
+        "K1": obj.K1,
+        "samples": obj.get_surface().shape[1] // 2,
+        "setup_ms": setup * 1000,
+        "compute_cold": cold,
+        "compute_warm": warm,
+        "rasterize_same_A": geometry_hit,
+        "backends_best_ms": backends,
+        "encode": encode,
+        "output_escape": output,
+        "output_delta": delta_output,
+    }
+
+
+def available_backends(obj):
+    return [backend for backend in Animation.BACKENDS.values()
+            if backend.available() and backend.supports(obj)]
+
+
+def time_process(command, first_output=False):
+    """ command を起動してから終了するまで (first_output なら最初の出力まで) の秒数 """
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if first_output:
+        process.stdout.read(1)
+        elapsed = time.perf_counter() - started
+        process.kill()
+    else:
+        process.communicate()
+        elapsed = time.perf_counter() - started
+    process.wait()
+    process.stdout.close()
+    return elapsed
+
+
+def count_frames(directory):
+    """ ディスクキャッシュに入っているフレームの数 """
+    return sum(name.endswith(".frame") for _, _, names in os.walk(directory) for name in names)
+
+
+def bench_startup(width, height, runs, cache_dir):
+    """
+    起動から最初のフレームが出力されるまでの時間を、Python と NumPy の起動時間と並べて測る
+    first_frame は既定の設定 (ディスクキャッシュは cache_dir) で、ディスクキャッシュなしの場合も測る
+    """
+    animation = [sys.executable, ANIMATION, "donut", "escape", "--size", "{}x{}".format(width, height),
+                 "--output", "-"]
+    commands = {
+        "first_frame": (animation + ["--disk-cache", cache_dir], True),
+        "first_frame_no_disk_cache": (animation + ["--no-disk-cache"], True),
+        "python": ([sys.executable, "-c", "pass"], False),
+        "numpy_import": ([sys.executable, "-c", "import numpy"], False),
+    }
+    # Startup work may grow with the cache, so say how full it was
+    result = {"width": width, "height": height, "disk_cache": cache_dir,
+              "disk_cache_frames": count_frames(cache_dir)}
+    for name, (command, first_output) in commands.items():
+        result[name] = summarize([time_process(command, first_output) for _ in range(runs)])
+    return result
+
+
+def apply_delta(screen, prefix, body, stride):
+    """ DeltaCharacter の出力を仮想画面 screen に適用する """
+    if prefix:
+        screen[:] = np.frombuffer(body + Animation.LINE_END,
+                                  dtype=np.uint8).reshape(screen.shape[0], stride)[:, :screen.shape[1]]
+        return
+    position = 0
+    while position < len(body):
+        end = body.index(b"H", position)
+        row, col = (int(value) - 1 for value in body[position + 2:end].split(b";"))
+        following = body.find(b"\x1b[", end)
+        if following < 0:
+            following = len(body)
+        text = np.frombuffer(body[end + 1:following], dtype=np.uint8)
+        screen[row, col:col + len(text)] = text
+        position = following
+
+
+def check_case(width, height, lod):
+    """ 各高速経路のフレームを参照実装と比べ、一致しないセルの数を返す """
+    obj = make_donut(width, height, lod)
+    stride = width + len(Animation.LINE_END)
+    # The reference does not cull. Where a back face won a cell, culling
+    # shows what lies behind it or leaves the cell empty; every other cell
+    # has to match.
+    references = []
+    back_faces = []
+    for A, B in CHECK_ANGLES:
+        back = bytearray(width * height)
+        references.append(np.frombuffer(obj.rasterize_reference(A, B, back_faces=back),
+                                        dtype=np.uint8).reshape(height, width))
+        back_faces.append(np.frombuffer(back, dtype=bool).reshape(height, width))
+    palette = np.frombuffer(Animation.PALETTE, dtype=np.uint8)
+    drawn = sum(int((reference > 0).sum()) for reference in references)
+
+    def compare(name, frames):
+        mismatched = 0
+        culled = 0
+        for reference, back, frame in zip(references, back_faces, frames):
+            if isinstance(frame, bytes):
+                frame = np.frombuffer(frame, dtype=np.uint8).reshape(height, stride)[:, :width]
+                reference = palette[reference]
+            different = reference != frame
+            mismatched += int((different & ~back).sum())
+            culled += int((different & back).sum())
+        return {"path": name, "mismatched_cells": mismatched, "back_face_cells_changed": culled,
+                "drawn_cells": drawn, "ok": mismatched <= drawn * TOLERANCE}
+
+    results = [compare("rasterize", [obj.rasterize(A, B) for A, B in CHECK_ANGLES])]
+    results.append(compare("compute_frame (cold)", [obj.compute_frame(A, B) for A, B in CHECK_ANGLES]))
+    results.append(compare("compute_frame (warm)", [obj.compute_frame(A, B) for A, B in CHECK_ANGLES]))
+
+    Animation._init_worker(obj)
+    results.append(compare("worker", [Animation._compute_frame_in_worker(A, B, 0)
+                                      for A, B in CHECK_ANGLES]))
+
+    with open(os.devnull, "wb") as devnull:
+        delta = Animation.DeltaCharacter(Animation.TerminalSession(devnull.fileno()))
+    screen = np.zeros((height, width), dtype=np.uint8)
+    screens = []
+    for A, B in CHECK_ANGLES:
+        apply_delta(screen, *delta.prepare(obj.compute_frame(A, B)), stride)
+        screens.append(Animation.LINE_END.join(row.tobytes() for row in screen)
+                       + Animation.LINE_END)
+    results.append(compare("delta renderer", screens))
+    results.append(compare("without numpy", [obj.frame_without_numpy(A, B)
+                                             for A, B in CHECK_ANGLES]))
+    for backend in available_backends(obj):
+        results.append(compare("backend " + backend.name, [backend.frame(obj, A, B)
+                                                          for A, B in CHECK_ANGLES]))
+    split = Animation.SplitBackend(3)
+    try:
+        results.append(compare("split into 3", [split.frame(obj, A, B) for A, B in CHECK_ANGLES]))
+    finally:
+        split.close()
+
+    return {"width": width, "height": height, "lod": lod, "paths": results}
+
+
+def parse_sizes(text):
+    sizes = []
+    for size in text.split(","):
+        width, height = size.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("80x24,120x40,200x60"),
+                        help="端末の大きさの一覧 (例: 80x24,200x60)")
+    parser.add_argument("--lods", default="0.5,1",
+                        help="標本化の細かさの一覧 (例: 0.5,1)")
+    parser.add_argument("--frames", type=int, default=30,
+                        help="1つの測定で計算するフレーム数")
+    parser.add_argument("--output", help="結果の JSON を書き込むファイル (省略すると標準出力)")
+    parser.add_argument("--skip-check", action="store_true", help="参照実装との比較を省略する")
+    parser.add_argument("--startup-runs", type=int, default=5,
+                        help="最初のフレームまでの時間を測る回数 (0 で省略)")
+    parser.add_argument("--startup-cache", metavar="DIR", default=Animation.default_cache_dir(),
+                        help="最初のフレームまでの時間を測るときのディスクキャッシュ (既定は Animation.py と同じ)")
+    args = parser.parse_args()
+    lods = [float(lod) for lod in args.lods.split(",")]
+
+    report = {"python": sys.version.split()[0], "numpy": np.__version__, "cases": [], "checks": []}
+    if args.startup_runs > 0:
+        report["startup"] = bench_startup(*args.sizes[0], args.startup_runs, args.startup_cache)
+    for width, height in args.sizes:
+        for lod in lods:
+            report["cases"].append(bench_case(width, height, lod, args.frames))
+            if not args.skip_check:
+                report["checks"].append(check_case(width, height, lod))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    failed = [check for check in report["checks"] if not all(path["ok"] for path in check["paths"])]
+    if failed:
+        print("differential check failed: {}".format(json.dumps(failed)), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,11 @@ K1 = 30
 screen_notes = [[None for i in range(int(MAX_RAD * 100) + 1)]
                     for j in range(int(MAX_RAD * 100) + 1)]
 
+# (sintheta, costheta, sinphi, cosphi) of every sample
+grid = None
+
+luminance_chars = np.array(list(".,-~:;=!*#$@"))
+
 """
 以下の二つの要素はそれぞれX軸、Z軸の回転速度を表します。
 0以上6.28以下で任意の値を設定できます。
@@ -69,69 +74,74 @@ def render_frame(output):
         sys.stdout.write(os.linesep)
     sys.stdout.flush()
 
+def sample_grid():
+    global grid
+    if grid is None:
+        thetas = []
+        theta = 0
+        while theta <= MAX_RAD:
+            thetas.append(theta)
+            theta += theta_spacing
+        phis = []
+        phi = 0
+        while phi <= MAX_RAD:
+            phis.append(phi)
+            phi += phi_spacing
+        theta, phi = np.meshgrid(thetas, phis, indexing="ij")
+        theta = theta.reshape(-1)
+        phi   = phi.reshape(-1)
+        grid = (np.sin(theta), np.cos(theta), np.sin(phi), np.cos(phi))
+    return grid
+
 def compute_frame(A, B):
     note_a = int(A * 100)
     note_b = int(B * 100)
     if not(screen_notes[note_a][note_b] is None):
         return screen_notes[note_a][note_b]
     
-    # zbuffer
-    zbuffer = np.zeros((SCREEN_WIDTH, SCREEN_HEIGHT))
-    # screen contents
-    output  = np.full((SCREEN_WIDTH, SCREEN_HEIGHT), ' ')
-
     # Precompute
     sinA = math.sin(A)
     cosA = math.cos(A)
     sinB = math.sin(B)
     cosB = math.cos(B)
 
-    theta = 0
-    while theta <= MAX_RAD:
-        # Precompute
-        sintheta = math.sin(theta)
-        costheta = math.cos(theta)
-        circlex = R2 + R1 * costheta
-        circley = R1 * sintheta
-
-        phi = 0
-        while phi <= MAX_RAD:
-            # Precompute
-            sinphi = math.sin(phi)
-            cosphi = math.cos(phi)
-
-            # Compute x, y, z
-            x = circlex * (cosB * cosphi + sinA * sinB * sinphi) - circley * cosA * sinB
-            y = circlex * (cosphi * sinB - cosB * sinA * sinphi) + circley * cosA * cosB
-            z = cosA * circlex * sinphi + circley * sinA
+    sintheta, costheta, sinphi, cosphi = sample_grid()
+    circlex = R2 + R1 * costheta
+    circley = R1 * sintheta
 
-            # Compute z position
-            zpos = z + K2
+    # Compute x, y, z for every sample at once
+    x = circlex * (cosB * cosphi + sinA * sinB * sinphi) - circley * cosA * sinB
+    y = circlex * (cosphi * sinB - cosB * sinA * sinphi) + circley * cosA * cosB
+    z = cosA * circlex * sinphi + circley * sinA
 
-            # compute zpos ^ -1
-            ooz = 1 / zpos
+    # compute zpos ^ -1
+    ooz = 1 / (z + K2)
 
-            # Compute xdash, ydash(scree上においての座標)
-            xdash = round(K1 * x * ooz)
-            ydash = round((K1 / 2) * y * ooz)
+    # Compute x position, y position
+    xpos = round((SCREEN_WIDTH)  / 2) + np.rint(K1 * x * ooz).astype(np.intp)
+    ypos = round((SCREEN_HEIGHT) / 2) - np.rint((K1 / 2) * y * ooz).astype(np.intp)
 
-            # Compute x position, y position
-            # xpos = (screen_width) / 2, ypos = (screen_height) / 2
-            xpos = round((SCREEN_WIDTH)  / 2) + xdash
-            ypos = round((SCREEN_HEIGHT) / 2) - ydash
+    # Compute luminance(L <= sqrt(2))
+    L = cosphi * costheta * sinB - cosA * costheta * sinphi - sinA * sintheta
 
-            # Compute luminance(L <= sqrt(2))
-            L = cosphi * costheta * sinB - cosA * costheta * sinphi - sinA * sintheta 
-            + cosB * (cosA * sintheta - costheta * sinA * sinphi)
+    visible = ((L > 0)
+               & (xpos >= 0) & (xpos < SCREEN_WIDTH)
+               & (ypos >= 0) & (ypos < SCREEN_HEIGHT))
+    cells = (xpos * SCREEN_HEIGHT + ypos)[visible]
+    ooz = ooz[visible]
+    L = L[visible]
 
-            # Seek display character
-            if L > 0 and ooz > zbuffer[xpos][ypos]:
-                zbuffer[xpos][ypos] = ooz
-                luminance_index = round(L * 8)
-                output[xpos][ypos] = ".,-~:;=!*#$@"[luminance_index]
+    # Keep the nearest (largest ooz) sample of every cell
+    order = np.lexsort((-ooz, cells))
+    cells = cells[order]
+    nearest = np.ones(len(cells), dtype=bool)
+    nearest[1:] = cells[1:] != cells[:-1]
+    winners = order[nearest]
 
-            phi += phi_spacing
-        theta += theta_spacing
+    # screen contents
+    output  = np.full((SCREEN_WIDTH, SCREEN_HEIGHT), ' ')
+    luminance_index = np.rint(L[winners] * 8).astype(np.intp)
+    output.reshape(-1)[cells[nearest]] = luminance_chars[luminance_index]
 
     # Store result
     screen_notes[note_a][note_b] = output